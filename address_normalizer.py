@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+ADDRESS NORMALIZER
+Registry text cleaning, canonical cache-key text and fuzzy facility-name
+matching, shared by ultimate_geocode.py and the index modules
+(local_gazetteer.py, settlement_boundaries.py, nearest_facility.py) without
+importing the geocoder itself
+"""
+import functools
+import re
+
+# Hospital-like POI names, matched by the settlement-wide Overpass fallback
+HOSPITAL_NAME_RE = re.compile(r'МБАЛ|болница', re.IGNORECASE)
+
+# Facility name matching: words that say what kind of company/facility it is,
+# not which one ("МБАЛ-Каварна ЕООД" and "Болница Каварна" share only "каварна")
+NAME_TOKEN_RE = re.compile(r'[^\W_]+')
+LEGAL_FORMS = {'ад', 'еад', 'оод', 'еоод', 'ет', 'кд', 'сд'}
+FACILITY_TYPES = {
+    'мбал', 'умбал', 'сбал', 'усбал', 'собал', 'сбалк', 'сбалпфз', 'сбпл', 'сбплр', 'сбр',
+    'дкц', 'кдц', 'дц', 'мц', 'мдц', 'дмц', 'смдл', 'амцсмп', 'коц', 'цпз', 'цсм',
+    'многопрофилна', 'специализирана', 'университетска', 'болница', 'за', 'активно', 'лечение',
+    'медицински', 'медицинска', 'диагностично', 'консултативен', 'център', 'центъра',
+    'hospital', 'clinic',
+}
+NAME_TITLES = {'проф', 'доц', 'акад', 'д', 'р', 'др'}
+NAME_STOPWORDS = LEGAL_FORMS | FACILITY_TYPES | NAME_TITLES
+# Name similarity (0..1) from which a POI counts as the registry facility
+POI_NAME_SIMILARITY = 0.5
+
+# Registry cleaning (raw НЗОК export -> hospitals_official_cleaned.csv)
+SETTLEMENT_PREFIX_RE = re.compile(r'^\s*(?:ГР|С|гр|с)\.\s*')
+NUMBER_SIGN_RE = re.compile(r'№\s*')
+COMPLEX_RE = re.compile(r'\b(?:ж\.\s*к\.?|жк\.)(?=\s|$|["„“”])', re.IGNORECASE)
+STREET_PREFIX_RE = re.compile(r'\b(ул|бул)\.(?=\S)', re.IGNORECASE)
+DOCTOR_TITLE_RE = re.compile(r'\bД-р\b')
+BLOCK_NUMBER_RE = re.compile(r'\bбл\.\s*(?=\d)')
+# Floor, entrance, cabinet and similar premises details
+_PREMISES = (r'(?:(?:ет|вх|каб|ап)(?:\.\s*|\s+(?=\d))[^\s,;]*|(?:кабинет|крило)\s+[^\s,;]+'
+             r'|партер|сутерен|приземен\s+етаж)')
+# Only a trailing run of them, with their extra numbers ('№ 13, вх. А, ет. 1',
+# 'ет.1 и част от ет.2', 'каб. 203 и 204'), so whatever follows a premises word
+# in the middle of an address is left alone
+PREMISES_RE = re.compile(
+    rf',?\s*\b{_PREMISES}(?:(?:\s*,\s*|\s+)(?:и\s+)?(?:част\s+от\s+)?(?:{_PREMISES}|\d[^\s,;]*))*'
+    r'(?:\s+и\s+[^\W\d_]+)?(?=\s*(?:;|$))',
+    re.IGNORECASE)
+# Trailing building part: 'корпус 2', 'от Терапевтичен корпус /блок 3/'
+BUILDING_PART_RE = re.compile(r'(?:\s+от\s+[^\W\d_]+)?\s+(?:корпус|/блок)\b[^;]*', re.IGNORECASE)
+WHITESPACE_RE = re.compile(r'\s+')
+MULTI_SEPARATOR_RE = re.compile(r'\s*;\s*')
+QUOTES_RE = re.compile(r'["„“”«»\']')
+PUNCTUATION_RE = re.compile(r'[.,]+')
+
+
+@functools.lru_cache(maxsize=16384)
+def clean_city(city):
+    """
+    'ГР.ВЕЛИКО ТЪРНОВО' -> 'Велико Търново'; Sofia districts are kept as-is
+    A ';'-list is cleaned part by part: 'ГР.ПЕТРИЧ; ГР.САНДАНСКИ' -> 'Петрич; Сандански'
+    """
+    parts = [part for part in MULTI_SEPARATOR_RE.split(WHITESPACE_RE.sub(' ', city).strip()) if part]
+    return '; '.join(SETTLEMENT_PREFIX_RE.sub('', part).title() if SETTLEMENT_PREFIX_RE.match(part) else part
+                     for part in parts)
+
+
+@functools.lru_cache(maxsize=16384)
+def clean_address(address):
+    """Strip №, floors/entrances/cabinets and normalize ж.к./ул. spelling"""
+    address = NUMBER_SIGN_RE.sub('', address)
+    address = COMPLEX_RE.sub('жк', address)
+    address = STREET_PREFIX_RE.sub(r'\1. ', address)
+    address = DOCTOR_TITLE_RE.sub('д-р', address)
+    address = BLOCK_NUMBER_RE.sub('', address)
+    address = BUILDING_PART_RE.sub('', address)
+    address = PREMISES_RE.sub('', address)
+    address = WHITESPACE_RE.sub(' ', address)
+    return address.strip(' ,')
+
+
+def split_addresses(address, city):
+    """
+    Split a multi-address cell ('ул. А 1; ул. Б 2') into (address, city) pairs
+    A matching ';'-list of settlements is paired up, otherwise the last one is reused
+    """
+    addresses = [a for a in MULTI_SEPARATOR_RE.split(address) if a]
+    cities = [c for c in MULTI_SEPARATOR_RE.split(city) if c] or [city]
+    return [(a, cities[min(i, len(cities) - 1)]) for i, a in enumerate(addresses)]
+
+
+def row_settlements(address, city):
+    """The cleaned settlements geocode() searches for a registry row (the POI index keys)"""
+    return [part_city for _, part_city in split_addresses(clean_address(address), clean_city(city))]
+
+
+@functools.lru_cache(maxsize=16384)
+def canonical_text(text):
+    """Case, quote, punctuation and prefix-insensitive form used in cache keys"""
+    text = QUOTES_RE.sub('', clean_address(text).lower())
+    # Every part of a ';'-list drops its prefix, so a raw multi-settlement cell
+    # and its clean_city() form share one key
+    text = '; '.join(SETTLEMENT_PREFIX_RE.sub('', part) for part in MULTI_SEPARATOR_RE.split(text))
+    return WHITESPACE_RE.sub(' ', PUNCTUATION_RE.sub(' ', text)).strip()
+
+
+@functools.lru_cache(maxsize=16384)
+def facility_name_tokens(name):
+    """Distinctive tokens of a facility name, without legal form, facility type and titles"""
+    tokens = NAME_TOKEN_RE.findall(str(name).lower())
+    distinctive = tuple(t for t in tokens if t not in NAME_STOPWORDS)
+    # A name made only of generic words ("МБАЛ ЕООД") still needs something to match on
+    return distinctive or tuple(t for t in tokens if t not in LEGAL_FORMS)
+
+
+def _trigrams(tokens):
+    grams = set()
+    for token in tokens:
+        padded = f" {token} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class NameIndex:
+    """
+    Fuzzy facility-name index for one settlement's POIs
+    Similarity blends trigram Dice (spelling variants, declensions) with token
+    overlap (word order, extra words); an inverted trigram index limits each
+    query to the entries sharing at least one trigram
+    """
+
+    def __init__(self, entries=()):
+        self.names = []
+        self.tokens = []
+        self.grams = []
+        self.payloads = []
+        self.postings = {}
+        for name, payload in entries:
+            self.add(name, payload)
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name, payload=None):
+        tokens = set(facility_name_tokens(name))
+        grams = _trigrams(tokens)
+        entry_id = len(self.names)
+        self.names.append(name)
+        self.tokens.append(tokens)
+        self.grams.append(len(grams))
+        self.payloads.append(payload)
+        for gram in grams:
+            self.postings.setdefault(gram, []).append(entry_id)
+
+    def top(self, query, k=5, min_similarity=0.0):
+        """Best k entries as (similarity, name, payload), most similar first"""
+        tokens = set(facility_name_tokens(query))
+        grams = _trigrams(tokens)
+        if not grams:
+            return []
+        shared = {}
+        for gram in grams:
+            for entry_id in self.postings.get(gram, ()):
+                shared[entry_id] = shared.get(entry_id, 0) + 1
+
+        matches = []
+        for entry_id, count in shared.items():
+            dice = 2 * count / (len(grams) + self.grams[entry_id])
+            entry_tokens = self.tokens[entry_id]
+            overlap = len(tokens & entry_tokens) / min(len(tokens), len(entry_tokens))
+            similarity = (dice + overlap) / 2
+            if similarity >= min_similarity:
+                matches.append((similarity, entry_id))
+        matches.sort(key=lambda m: (-m[0], m[1]))
+        return [(round(sim, 3), self.names[i], self.payloads[i]) for sim, i in matches[:k]]
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+"""
+GEOCODING BENCHMARK
+Replays recorded provider responses through a local Nominatim/Overpass
+stand-in and measures the geocoding pipeline without touching public APIs
+
+Recordings are the raw response cache (response_cache/) that every normal
+run of ultimate_geocode.py fills. The benchmark geocodes in a scratch
+directory, so the winner cache and response cache start cold.
+
+Reports rows/s, requests per row, cache hit ratio, p50/p95/p99 latency per
+strategy and quality-tier counts; compares them with a saved baseline.
+
+Usage:
+  python benchmark_geocode.py --limit 200 --save-baseline bench_baseline.json
+  python benchmark_geocode.py --limit 200 --baseline bench_baseline.json --latency 0.05 --throttle 0.02
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl
+
+import numpy as np
+import pandas as pd
+
+import ultimate_geocode as ug
+
+
+class StandInServer:
+    """
+    Local HTTP server answering Nominatim /search and Overpass /api/interpreter
+    from recorded responses, with optional latency and 429 injection
+    Unrecorded queries get an empty (but valid) answer
+    """
+
+    def __init__(self, recordings, latency=0.0, jitter=0.0, throttle=0.0, seed=0):
+        self.recordings = recordings
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle = throttle
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {'requests': 0, 'recorded': 0, 'missing': 0, 'throttled': 0}
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _count(self, key):
+        with self.lock:
+            self.counts[key] += 1
+
+    def _draw(self):
+        with self.lock:
+            delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+            throttled = self.random.random() < self.throttle
+        return delay, throttled
+
+    def respond(self, path, params):
+        """(status, payload) for one request"""
+        self._count('requests')
+        delay, throttled = self._draw()
+        if delay:
+            time.sleep(delay)
+        if throttled:
+            self._count('throttled')
+            return 429, {'error': 'Too Many Requests'}
+
+        if path.endswith('/interpreter'):
+            endpoint, empty = 'overpass/interpreter', {'elements': []}
+        else:
+            endpoint, empty = 'nominatim/search', []
+        payload = self.recordings.get(endpoint, params)
+        self._count('missing' if payload is None else 'recorded')
+        return 200, empty if payload is None else payload
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, params):
+                status, payload = server.respond(urlsplit(self.path).path, params)
+                body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                if status == 429:
+                    self.send_header('Retry-After', '1')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self._reply(dict(parse_qsl(urlsplit(self.path).query, keep_blank_values=True)))
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length).decode('utf-8')
+                self._reply(dict(parse_qsl(body, keep_blank_values=True)))
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+class BenchmarkObserver:
+    """Collects geocoder fetch/strategy events (thread-safe)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.strategy_seconds = {}
+        self.fetches = {'cached': 0, 'network': 0, 'errors': 0}
+
+    def __call__(self, event, fields):
+        with self.lock:
+            if event == 'strategy':
+                self.strategy_seconds.setdefault(fields['strategy'], []).append(fields['seconds'])
+            elif event == 'fetch':
+                self.fetches['cached' if fields['cached'] else 'network'] += 1
+                if fields['status'] not in (None, 200):
+                    self.fetches['errors'] += 1
+
+
+def run_benchmark(source, recordings, limit=None, workers=4, rate=50.0, confidence=80,
+                  latency=0.0, jitter=0.0, throttle=0.0, chunk_size=500):
+    """Geocode `source` against the stand-in in a scratch directory, returns the report dict"""
+    source = os.path.abspath(source)
+    recordings = ug.ResponseCache(os.path.abspath(recordings))
+    workdir = tempfile.mkdtemp(prefix='geocode_bench_')
+    cwd = os.getcwd()
+    observer = BenchmarkObserver()
+
+    with StandInServer(recordings, latency, jitter, throttle) as server:
+        try:
+            os.chdir(workdir)
+            geocoder = ug.UltimateGeocoder(
+                rate_limits={backend: rate for backend in ug.RATE_LIMITS},
+                pool_size=workers, confidence_threshold=confidence,
+                urls={'nominatim': f"{server.url}/search", 'overpass': f"{server.url}/api/interpreter"})
+            geocoder.observers.append(observer)
+            writer = ug.ResultWriter(source, tiers={})
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for chunk in pd.read_csv(source, encoding='utf-8', chunksize=chunk_size, nrows=limit):
+                    for col in ug.RESULT_COLUMNS:
+                        if col not in chunk.columns:
+                            chunk[col] = None
+                    geocoder.prefetch_settlements(
+                        [settlement for addr, city in zip(chunk['Адрес'].fillna('').astype(str),
+                                                          chunk['Населено място'].fillna('').astype(str))
+                         for settlement in ug.row_settlements(addr, city)],
+                        workers=workers)
+                    for row, result, requests_used in ug._geocode_chunk(
+                            geocoder, pool, chunk, window=workers * 4):
+                        writer.write(row, result, requests_used)
+            elapsed = time.perf_counter() - start
+            writer.close()
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    rows = max(writer.next_row, 1)
+    fetches = observer.fetches
+    lookups = fetches['cached'] + fetches['network']
+    return {
+        'source': os.path.basename(source),
+        'rows': writer.next_row,
+        'seconds': round(elapsed, 3),
+        'rows_per_sec': round(writer.next_row / elapsed, 3) if elapsed > 0 else 0.0,
+        'requests_per_row': round(server.counts['requests'] / rows, 3),
+        'cache_hit_ratio': round(fetches['cached'] / lookups, 3) if lookups else 0.0,
+        'replay_coverage': round(server.counts['recorded'] / max(server.counts['requests'], 1), 3),
+        'server': dict(server.counts),
+        'strategies': {
+            strategy: {
+                'calls': len(seconds),
+                **{f"p{q}_ms": round(float(np.percentile(seconds, q)) * 1000, 2) for q in (50, 95, 99)},
+            }
+            for strategy, seconds in sorted(observer.strategy_seconds.items())
+        },
+        'tiers': dict(writer.stats),
+    }
+
+
+def find_regressions(report, baseline, tolerance=0.10, min_latency_ms=5.0):
+    """Human-readable list of metrics that got worse than the baseline beyond `tolerance`"""
+    regressions = []
+
+    def worse(name, old, new, higher_is_better):
+        if old is None or new is None:
+            return
+        change = (new - old) / old if old else 0.0
+        if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+            regressions.append(f"{name}: {old} -> {new} ({change:+.0%})")
+
+    worse('rows_per_sec', baseline.get('rows_per_sec'), report['rows_per_sec'], True)
+    worse('requests_per_row', baseline.get('requests_per_row'), report['requests_per_row'], False)
+    worse('cache_hit_ratio', baseline.get('cache_hit_ratio'), report['cache_hit_ratio'], True)
+
+    for strategy, stats in report['strategies'].items():
+        old = baseline.get('strategies', {}).get(strategy)
+        if not old:
+            continue
+        for q in ('p50_ms', 'p95_ms', 'p99_ms'):
+            # Sub-millisecond timings are noise, not regressions
+            if max(old[q], stats[q]) >= min_latency_ms:
+                worse(f"{strategy} {q}", old[q], stats[q], False)
+
+    # Quality: any loss of good results counts, no tolerance
+    old_tiers = baseline.get('tiers', {})
+    for tier in ('excellent', 'good', 'fair'):
+        if tier in old_tiers and report['tiers'][tier] < old_tiers[tier]:
+            regressions.append(f"tier {tier}: {old_tiers[tier]} -> {report['tiers'][tier]}")
+    if 'failed' in old_tiers and report['tiers']['failed'] > old_tiers['failed']:
+        regressions.append(f"tier failed: {old_tiers['failed']} -> {report['tiers']['failed']}")
+    return regressions
+
+
+def print_report(report):
+    print("="*70)
+    print(f"BENCHMARK: {report['source']} ({report['rows']} rows in {report['seconds']:.1f}s)")
+    print("="*70)
+    print(f"Rows/s: {report['rows_per_sec']:.2f} | Requests/row: {report['requests_per_row']:.2f} | "
+          f"Cache hit ratio: {report['cache_hit_ratio']:.1%} | Replay coverage: {report['replay_coverage']:.1%}")
+    print(f"Stand-in: {report['server']}")
+    print()
+    print(f"{'Strategy':<32}{'calls':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for strategy, stats in report['strategies'].items():
+        print(f"{strategy:<32}{stats['calls']:>7}{stats['p50_ms']:>10.1f}"
+              f"{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}")
+    print()
+    tiers = report['tiers']
+    print(f"Quality: Excellent={tiers['excellent']} Good={tiers['good']} "
+          f"Fair={tiers['fair']} Failed={tiers['failed']}")
+
+
+def default_source():
+    for path in ('hospitals_official_improved.csv', 'hospitals_official_cleaned.csv', 'hospitals_offical.csv'):
+        if os.path.exists(path):
+            return path
+    return 'hospitals_offical.csv'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Replay benchmark for the hospital geocoder')
+    parser.add_argument('--source', default=default_source(),
+                        help='Registry CSV to geocode (default: same choice as ultimate_geocode.py)')
+    parser.add_argument('--recordings', default='response_cache',
+                        help='Raw response cache replayed by the stand-in (default: response_cache)')
+    parser.add_argument('--limit', type=int, help='Only the first N registry rows')
+    parser.add_argument('--workers', type=int, default=4, help='Concurrent rows (default: 4)')
+    parser.add_argument('--rate', type=float, default=50.0,
+                        help='Requests/s allowed per backend against the stand-in (default: 50)')
+    parser.add_argument('--confidence', type=int, default=80, help='Early-stop score (default: 80)')
+    parser.add_argument('--latency', type=float, default=0.0, help='Stand-in response delay, seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Uniform +/- jitter on the delay, seconds')
+    parser.add_argument('--throttle', type=float, default=0.0, help='Share of requests answered with 429')
+    parser.add_argument('--baseline', help='Baseline report JSON to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help='Relative change allowed before a metric is flagged (default: 0.10)')
+    parser.add_argument('--save-baseline', metavar='PATH', help='Write this run as the new baseline')
+    parser.add_argument('--json', metavar='PATH', help='Write the report as JSON')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run_benchmark(args.source, args.recordings, limit=args.limit, workers=args.workers,
+                           rate=args.rate, confidence=args.confidence, latency=args.latency,
+                           jitter=args.jitter, throttle=args.throttle)
+    print_report(report)
+
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            print(f"Report saved: {path}")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = find_regressions(report, baseline, args.tolerance)
+        print()
+        if regressions:
+            print(f"REGRESSIONS vs {args.baseline}:")
+            for line in regressions:
+                print(f"  ✗ {line}")
+            return 1
+        print(f"No regressions vs {args.baseline}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+MAP DATA EXPORT
+Precomputes what index.html needs from hospitals_ultimate_coords.csv, so the
+map no longer downloads and parses the whole CSV in the browser
+
+map_data/
+  index.json          totals, quality counts and one entry per Област with
+                      its bbox and grid cluster summaries (enough for the
+                      country-wide view)
+  points/NN.json      compact GeoJSON per Област: coordinates + id + score
+  details/NN.json     popup fields per Област (name, address, manager,
+                      phone, provider), fetched only when a popup opens
+
+Runs at the end of ultimate_geocode.py (and --improve); standalone:
+  python export_map_data.py [--source hospitals_ultimate_coords.csv] [--out map_data]
+"""
+import argparse
+import json
+import os
+
+import pandas as pd
+
+from ultimate_geocode import OUTPUT_FILE, _quality_tier
+
+MAP_DATA_DIR = 'map_data'
+# Cluster summary cell size in degrees (~5 km)
+CLUSTER_CELL = 0.05
+# Popup fields, kept out of the point files
+DETAIL_COLUMNS = ['Наименование', 'Община', 'Населено място', 'Адрес', 'Управител', 'Телефон', 'provider']
+COORD_DECIMALS = 6
+
+
+def _write_json(path, data):
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp, path)
+
+
+def _clusters(points, cell):
+    """Grid cluster summaries: [lat, lng, count, excellent count] per occupied cell"""
+    cells = {}
+    for lat, lng, score in points:
+        key = (int(lat // cell), int(lng // cell))
+        summary = cells.setdefault(key, [0.0, 0.0, 0, 0])
+        summary[0] += lat
+        summary[1] += lng
+        summary[2] += 1
+        summary[3] += score >= 80
+    return [[round(lat / n, 4), round(lng / n, 4), n, excellent] for lat, lng, n, excellent in cells.values()]
+
+
+def export(source=OUTPUT_FILE, out_dir=MAP_DATA_DIR, cell=CLUSTER_CELL, chunk_size=5000):
+    """Write the map data files, returns the index dictionary"""
+    oblasts = {}
+    quality = {'excellent': 0, 'good': 0, 'fair': 0, 'failed': 0}
+    total = 0
+    row_id = 0
+
+    for chunk in pd.read_csv(source, encoding='utf-8', dtype=str, keep_default_na=False, chunksize=chunk_size):
+        lat = pd.to_numeric(chunk['lat'], errors='coerce')
+        lng = pd.to_numeric(chunk['lng'], errors='coerce')
+        scores = pd.to_numeric(chunk['quality_score'], errors='coerce').fillna(0).astype(int)
+        details = chunk.reindex(columns=DETAIL_COLUMNS, fill_value='')
+        rows = zip(chunk['Област'], lat, lng, scores, details.itertuples(index=False, name=None))
+        for i, (oblast, y, x, score, fields) in enumerate(rows, start=row_id):
+            total += 1
+            quality[_quality_tier(score)] += 1
+            if y != y or x != x:
+                continue
+            entry = oblasts.setdefault(oblast.strip(), {'ids': [], 'points': [], 'details': []})
+            entry['ids'].append(i)
+            entry['points'].append((y, x, score))
+            entry['details'].append(list(fields))
+        row_id += len(chunk)
+
+    os.makedirs(os.path.join(out_dir, 'points'), exist_ok=True)
+    os.makedirs(os.path.join(out_dir, 'details'), exist_ok=True)
+    index = {
+        'source': os.path.basename(source),
+        'total': total,
+        'with_coords': sum(len(e['points']) for e in oblasts.values()),
+        'quality': quality,
+        'cell': cell,
+        'detail_columns': DETAIL_COLUMNS,
+        'oblasts': [],
+    }
+    for n, oblast in enumerate(sorted(oblasts), start=1):
+        entry = oblasts[oblast]
+        slug = f"{n:02d}"
+        points = entry['points']
+        _write_json(os.path.join(out_dir, 'points', f"{slug}.json"), {
+            'type': 'FeatureCollection',
+            'features': [
+                {'type': 'Feature',
+                 'geometry': {'type': 'Point', 'coordinates': [round(x, COORD_DECIMALS), round(y, COORD_DECIMALS)]},
+                 'properties': {'i': i, 'q': score}}
+                for i, (y, x, score) in zip(entry['ids'], points)
+            ],
+        })
+        _write_json(os.path.join(out_dir, 'details', f"{slug}.json"),
+                    {str(i): fields for i, fields in zip(entry['ids'], entry['details'])})
+        lats = [p[0] for p in points]
+        lngs = [p[1] for p in points]
+        index['oblasts'].append({
+            'name': oblast,
+            'slug': slug,
+            'count': len(points),
+            'excellent': sum(1 for p in points if p[2] >= 80),
+            'bbox': [round(min(lats), 4), round(min(lngs), 4), round(max(lats), 4), round(max(lngs), 4)],
+            'clusters': _clusters(points, cell),
+        })
+    # Written last: a reader never sees an index pointing at missing files
+    _write_json(os.path.join(out_dir, 'index.json'), index)
+    return index
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Export compact map data for index.html')
+    parser.add_argument('--source', default=OUTPUT_FILE, help=f'Geocoded registry (default: {OUTPUT_FILE})')
+    parser.add_argument('--out', default=MAP_DATA_DIR, help=f'Output directory (default: {MAP_DATA_DIR})')
+    parser.add_argument('--cell', type=float, default=CLUSTER_CELL,
+                        help=f'Cluster summary cell size in degrees (default: {CLUSTER_CELL})')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    index = export(args.source, args.out, args.cell)
+    print(f"Map data: {index['with_coords']} of {index['total']} rows in "
+          f"{len(index['oblasts'])} oblasts -> {args.out}/")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+GEOCODING CLIENT
+Thin client for geocode_service.py - standard library only, so it starts in
+milliseconds (no pandas, no cache loading)
+
+Usage:
+  python geocode_client.py "ул. Васил Левски 36" Каварна --oblast Добрич
+  python geocode_client.py "бул. България 1" Плевен --socket /tmp/geocode.sock --json
+  python geocode_client.py --batch queries.jsonl     # one {"address":..,"city":..} per line
+"""
+import argparse
+import http.client
+import json
+import socket
+import sys
+from urllib.parse import urlencode, urlsplit
+
+DEFAULT_URL = 'http://127.0.0.1:8765'
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP over a Unix socket"""
+
+    def __init__(self, path, timeout=60):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def request(method, path, payload=None, url=DEFAULT_URL, socket_path=None, timeout=60):
+    """Call the service, returns the decoded JSON reply; raises RuntimeError on an error reply"""
+    if socket_path:
+        conn = UnixHTTPConnection(socket_path, timeout)
+    else:
+        conn = http.client.HTTPConnection(urlsplit(url).netloc, timeout=timeout)
+    try:
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8') if payload is not None else None
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        conn.request(method, path, body=body, headers=headers)
+        resp = conn.getresponse()
+        data = json.loads(resp.read() or b'null')
+    finally:
+        conn.close()
+    if resp.status != 200:
+        raise RuntimeError(f"{resp.status}: {(data or {}).get('error', resp.reason)}")
+    return data
+
+
+def geocode(address, city, oblast=None, name=None, municipality=None, **connection):
+    query = {'address': address, 'city': city, 'oblast': oblast, 'name': name, 'municipality': municipality}
+    return request('GET', '/geocode?' + urlencode({k: v for k, v in query.items() if v}), **connection)
+
+
+def batch(queries, **connection):
+    return request('POST', '/batch', list(queries), **connection)
+
+
+def _read_queries(path):
+    with (sys.stdin if path == '-' else open(path, 'r', encoding='utf-8')) as f:
+        text = f.read().strip()
+    if text.startswith('['):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def _format(result):
+    if result.get('error'):
+        return f"error: {result['error']}"
+    if result.get('lat') is None:
+        return 'not found'
+    return (f"{result['lat']},{result['lng']}\t{result['quality_score']}\t"
+            f"{result['provider']}\t{result['display_name']}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Client for geocode_service.py')
+    parser.add_argument('address', nargs='?', help='Street address, e.g. "ул. Васил Левски 36"')
+    parser.add_argument('city', nargs='?', help='Settlement (Населено място)')
+    parser.add_argument('--oblast', help='Област')
+    parser.add_argument('--municipality', help='Община')
+    parser.add_argument('--name', help='Facility name (enables the POI lookup)')
+    parser.add_argument('--batch', metavar='FILE',
+                        help="JSON array or JSON lines of queries ('-' for stdin)")
+    parser.add_argument('--url', default=DEFAULT_URL, help=f'Service URL (default: {DEFAULT_URL})')
+    parser.add_argument('--socket', metavar='PATH', help='Connect to a Unix-socket service instead')
+    parser.add_argument('--timeout', type=float, default=60, help='Seconds to wait for the reply (default: 60)')
+    parser.add_argument('--json', action='store_true', help='Print the raw JSON reply')
+    args = parser.parse_args(argv)
+    if args.batch is None and not (args.address and args.city):
+        parser.error('give ADDRESS CITY or --batch FILE')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    connection = {'url': args.url, 'socket_path': args.socket, 'timeout': args.timeout}
+    try:
+        if args.batch is not None:
+            results = batch(_read_queries(args.batch), **connection)
+        else:
+            results = [geocode(args.address, args.city, args.oblast, args.name, args.municipality, **connection)]
+    except (OSError, RuntimeError) as e:
+        print(f"geocode_client: {e}", file=sys.stderr)
+        return 2
+
+    if args.json:
+        print(json.dumps(results if args.batch is not None else results[0], ensure_ascii=False, indent=2))
+    else:
+        for result in results:
+            print(_format(result))
+    return 0 if all(r.get('lat') is not None for r in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
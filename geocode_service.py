@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+GEOCODING SERVICE
+Long-running UltimateGeocoder behind a local HTTP or Unix-socket API, so the
+winner cache, normalizer caches and HTTP connection pools stay warm between
+lookups
+
+Endpoints:
+  GET  /geocode?address=...&city=...[&oblast=&name=&municipality=]
+  POST /geocode   {"address": ..., "city": ..., ...}
+  POST /batch     [{"address": ..., "city": ...}, ...]
+  GET  /health
+  GET  /metrics   (Prometheus text format)
+
+Identical lookups in flight at the same time (same canonical address key)
+share a single geocode() call.
+
+Usage:
+  python geocode_service.py                        # http://127.0.0.1:8765
+  python geocode_service.py --socket /tmp/geocode.sock --gazetteer local_gazetteer.json
+  python geocode_client.py "ул. Васил Левски 36" Каварна --oblast Добрич
+Any other option is passed to the geocoder (see ultimate_geocode.py --help).
+"""
+import argparse
+import json
+import logging
+import os
+import socketserver
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl
+
+import ultimate_geocode as ug
+
+DEFAULT_PORT = 8765
+QUERY_FIELDS = ('address', 'city', 'oblast', 'name', 'municipality')
+# Largest accepted request body
+MAX_BODY = 16 * 1024 * 1024
+
+
+class GeocodeService:
+    """Warm geocoder with in-flight request coalescing"""
+
+    def __init__(self, geocoder, workers=4):
+        self.geocoder = geocoder
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.started = time.time()
+        self.coalesced = 0
+        # cache key -> Future of the geocode() call currently resolving it
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def geocode(self, query):
+        """One lookup: query dict with address/city[/oblast/name/municipality] -> result dict"""
+        address, city, oblast, name, municipality = (str(query.get(f) or '').strip() for f in QUERY_FIELDS)
+        if not address or not city:
+            raise ValueError('address and city are required')
+        key = self.geocoder.cache_key(address, city, oblast)
+
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+            else:
+                self.coalesced += 1
+        if owner:
+            try:
+                result = self.geocoder.geocode(address, city, oblast, name or None,
+                                               municipality=municipality or None)
+                future.set_result((result, self.geocoder.last_requests))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    del self._inflight[key]
+
+        (lat, lng, provider, display, score), requests_used = future.result()
+        return {
+            'lat': lat,
+            'lng': lng,
+            'provider': provider,
+            'display_name': display,
+            'quality_score': score,
+            'requests': requests_used if owner else 0,
+            'coalesced': not owner,
+        }
+
+    def batch(self, queries):
+        """Many lookups concurrently, results in input order; a bad query gets an error entry"""
+        def lookup(query):
+            try:
+                return self.geocode(_expect(query, dict))
+            except ValueError as e:
+                return {'error': str(e)}
+        return list(self.pool.map(lookup, queries))
+
+    def health(self):
+        return {
+            'status': 'ok',
+            'uptime': round(time.time() - self.started, 1),
+            'cache_entries': len(self.geocoder.cache),
+            'in_flight': len(self._inflight),
+            'coalesced': self.coalesced,
+            'offline': self.geocoder.offline,
+        }
+
+
+def make_handler(service, metrics=None):
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, status, payload, content_type='application/json; charset=utf-8'):
+            body = payload if isinstance(payload, bytes) else json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _body(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            if length > MAX_BODY:
+                raise ValueError('request body too large')
+            return json.loads(self.rfile.read(length) or b'null')
+
+        def _handle(self, call):
+            try:
+                self._reply(200, call())
+            except ValueError as e:  # includes malformed JSON
+                self._reply(400, {'error': str(e)})
+            except Exception as e:
+                logging.exception(f"Geocoding service error on {self.path}")
+                self._reply(500, {'error': str(e)})
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            if url.path == '/geocode':
+                self._handle(lambda: service.geocode(dict(parse_qsl(url.query))))
+            elif url.path == '/health':
+                self._reply(200, service.health())
+            elif url.path == '/metrics' and metrics is not None:
+                self._reply(200, metrics.render().encode('utf-8'), 'text/plain; version=0.0.4')
+            else:
+                self._reply(404, {'error': 'not found'})
+
+        def do_POST(self):
+            path = urlsplit(self.path).path
+            if path == '/geocode':
+                self._handle(lambda: service.geocode(_expect(self._body(), dict)))
+            elif path == '/batch':
+                self._handle(lambda: service.batch(_expect(self._body(), list)))
+            else:
+                self._reply(404, {'error': 'not found'})
+
+        def log_message(self, format, *args):
+            logging.debug(f"service: {format % args}")
+
+    return Handler
+
+
+def _expect(value, kind):
+    if not isinstance(value, kind):
+        raise ValueError(f"expected a JSON {'object' if kind is dict else 'array'}")
+    return value
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        # A socket file left behind by a previous run would make bind() fail
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        super().server_bind()
+        self.server_name, self.server_port = 'localhost', 0
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Long-running geocoding service',
+        epilog='Any other option is passed to the geocoder (see ultimate_geocode.py --help)')
+    parser.add_argument('--host', default='127.0.0.1', help='Listen address (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f'Listen port (default: {DEFAULT_PORT})')
+    parser.add_argument('--socket', metavar='PATH', help='Listen on a Unix socket instead of TCP')
+    args, rest = parser.parse_known_args(argv)
+    return args, ug.parse_args(rest)
+
+
+def main(argv=None):
+    args, geocoder_args = parse_args(argv)
+    geocoder, metrics, trace = ug.build_geocoder(geocoder_args)
+    service = GeocodeService(geocoder, workers=geocoder_args.workers)
+    handler = make_handler(service, metrics)
+
+    if args.socket:
+        server = UnixHTTPServer(args.socket, handler)
+        where = f"unix:{args.socket}"
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), handler)
+        server.daemon_threads = True
+        where = f"http://{args.host}:{args.port}"
+    print(f"Geocoding service on {where} ({len(geocoder.cache)} cached entries)")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.pool.shutdown(wait=False)
+        if trace is not None:
+            trace.close()
+        if geocoder_args.metrics:
+            metrics.dump(geocoder_args.metrics)
+
+
+if __name__ == '__main__':
+    main()
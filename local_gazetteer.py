@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""
+LOCAL GAZETTEER
+Offline geocoding index consulted by UltimateGeocoder before any network call
+
+Built once from local sources, then loaded as in-memory dictionaries:
+  settlement -> street -> house number -> coordinates
+  settlement -> healthcare POIs (name index)
+
+Supported sources:
+  - CSV with columns city/street/housenumber/lat/lon[/name/amenity]
+    (OSM-style addr:city, addr:street, addr:housenumber also accepted)
+  - GeoJSON FeatureCollection or GeoJSON sequence (.geojsonl/.geojsonseq),
+    e.g. `osmium export bulgaria-latest.osm.pbf -f geojsonseq -o bg.geojsonseq`
+  - OSM XML (.osm) for small extracts (ways are placed at their node centroid)
+
+Usage:
+  python ultimate_geocode.py --build-gazetteer bg.geojsonseq streets.csv
+  python ultimate_geocode.py --gazetteer local_gazetteer.json
+"""
+import csv
+import json
+import logging
+import re
+import xml.etree.ElementTree as ET
+
+from address_normalizer import canonical_text, HOSPITAL_NAME_RE, NameIndex, POI_NAME_SIMILARITY
+
+GAZETTEER_FILE = 'local_gazetteer.json'
+HEALTHCARE_AMENITIES = {'hospital', 'clinic', 'doctors'}
+
+# Street type words dropped from index keys ("улица Васил Левски" == "Васил Левски")
+STREET_TYPE_RE = re.compile(r'^(?:ул|улица|бул|булевард|жк|ж к|кв|квартал|пл|площад)\s+')
+HOUSE_NUMBER_SPACE_RE = re.compile(r'\s+')
+GEOJSON_SEQUENCE_SUFFIXES = ('.geojsonl', '.geojsonseq', '.geojsons', '.jsonl')
+
+TAG_ALIASES = {
+    'city': ('addr:city', 'city', 'settlement', 'addr:place'),
+    'street': ('addr:street', 'street'),
+    'housenumber': ('addr:housenumber', 'housenumber', 'house_number'),
+    'name': ('name',),
+    'amenity': ('amenity', 'healthcare'),
+}
+
+
+def _street_key(street):
+    return STREET_TYPE_RE.sub('', canonical_text(street))
+
+
+def _grams(key):
+    return {key[i:i + 3] for i in range(len(key) - 2)}
+
+
+def _number_key(number):
+    return HOUSE_NUMBER_SPACE_RE.sub('', str(number)).lower()
+
+
+def _tag(tags, field):
+    for alias in TAG_ALIASES[field]:
+        value = tags.get(alias)
+        if value:
+            return str(value).strip()
+    return ''
+
+
+class LocalGazetteer:
+    """In-memory address and POI index with an on-disk JSON form"""
+
+    def __init__(self, addresses=None, streets=None, pois=None):
+        # canonical city -> street key -> number key -> [lat, lon, city, street, number]
+        self.addresses = addresses or {}
+        # canonical city -> street key -> [lat, lon, city, street]
+        self.streets = streets or {}
+        # canonical city -> [[name, lat, lon, amenity, city, street, number], ...]
+        self.pois = pois or {}
+        # canonical city -> NameIndex over its POIs, built on first lookup
+        self._poi_names = {}
+        # canonical city -> (street keys, trigram -> positions in them), built on first lookup
+        self._street_grams = {}
+
+    # === Building ===
+
+    def add(self, tags, lat, lon):
+        """Index one feature given its OSM-style tags and coordinates"""
+        city = _tag(tags, 'city')
+        if not city:
+            return
+        city_key = canonical_text(city)
+        street = _tag(tags, 'street')
+        number = _tag(tags, 'housenumber')
+        lat, lon = str(lat), str(lon)
+
+        if street:
+            street_key = _street_key(street)
+            self.streets.setdefault(city_key, {}).setdefault(street_key, [lat, lon, city, street])
+            if number:
+                self.addresses.setdefault(city_key, {}).setdefault(street_key, {}).setdefault(
+                    _number_key(number), [lat, lon, city, street, number])
+
+        name = _tag(tags, 'name')
+        amenity = _tag(tags, 'amenity')
+        if name and (amenity in HEALTHCARE_AMENITIES or HOSPITAL_NAME_RE.search(name)):
+            self.pois.setdefault(city_key, []).append([name, lat, lon, amenity, city, street, number])
+
+    def add_csv(self, path):
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            for row in csv.DictReader(f):
+                lat = row.get('lat')
+                lon = row.get('lon') or row.get('lng')
+                if lat and lon:
+                    self.add(row, lat, lon)
+
+    def add_geojson(self, path):
+        for feature in read_geojson_features(path):
+            point = _centroid(feature.get('geometry') or {})
+            if point:
+                self.add(feature.get('properties') or {}, point[1], point[0])
+
+    def add_osm_xml(self, path):
+        nodes = {}
+        for _, el in ET.iterparse(path, events=('end',)):
+            if el.tag == 'node':
+                lat, lon = el.get('lat'), el.get('lon')
+                nodes[el.get('id')] = (lat, lon)
+                tags = {t.get('k'): t.get('v') for t in el.findall('tag')}
+                if tags:
+                    self.add(tags, lat, lon)
+                el.clear()
+            elif el.tag == 'way':
+                tags = {t.get('k'): t.get('v') for t in el.findall('tag')}
+                refs = [nodes[nd.get('ref')] for nd in el.findall('nd') if nd.get('ref') in nodes]
+                if tags and refs:
+                    lat = sum(float(r[0]) for r in refs) / len(refs)
+                    lon = sum(float(r[1]) for r in refs) / len(refs)
+                    self.add(tags, f"{lat:.7f}", f"{lon:.7f}")
+                el.clear()
+
+    @classmethod
+    def build(cls, sources):
+        gazetteer = cls()
+        for path in sources:
+            if path.endswith('.csv'):
+                gazetteer.add_csv(path)
+            elif path.endswith('.osm'):
+                gazetteer.add_osm_xml(path)
+            else:
+                gazetteer.add_geojson(path)
+            logging.info(f"Gazetteer source indexed: {path}")
+        return gazetteer
+
+    def save(self, path=GAZETTEER_FILE):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'addresses': self.addresses, 'streets': self.streets, 'pois': self.pois},
+                      f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path=GAZETTEER_FILE):
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return cls(data.get('addresses'), data.get('streets'), data.get('pois'))
+
+    def stats(self):
+        return {
+            'settlements': len(set(self.streets) | set(self.pois)),
+            'streets': sum(len(s) for s in self.streets.values()),
+            'addresses': sum(len(n) for s in self.addresses.values() for n in s.values()),
+            'pois': sum(len(p) for p in self.pois.values()),
+        }
+
+    # === Lookup ===
+
+    def search(self, city, street_name=None, street_number=None, name=None, limit=10):
+        """
+        Nominatim-shaped results for a registry row, so the geocoder's
+        _score_result rules apply to them unchanged
+        """
+        city_key = canonical_text(city)
+        results = []
+
+        if street_name:
+            streets = self.streets.get(city_key, {})
+            street_key = _street_key(street_name)
+            if street_key in streets:
+                street_keys = [street_key]
+            elif len(street_key) > 3:
+                # Partial match, e.g. "Стамболийски" vs "Александър Стамболийски"
+                street_keys = self._partial_streets(city_key, street_key)[:3]
+            else:
+                street_keys = []
+
+            numbers = self.addresses.get(city_key, {})
+            for key in street_keys:
+                entry = numbers.get(key, {}).get(_number_key(street_number)) if street_number else None
+                if entry:
+                    results.append(_address_result(*entry))
+                else:
+                    lat, lon, result_city, street = streets[key]
+                    results.append(_address_result(lat, lon, result_city, street, ''))
+
+        if name and city_key in self.pois:
+            names = self._poi_names.get(city_key)
+            if names is None:
+                names = self._poi_names[city_key] = NameIndex((poi[0], poi) for poi in self.pois[city_key])
+            for _, _, poi in names.top(name, k=3, min_similarity=POI_NAME_SIMILARITY):
+                results.append(_poi_result(*poi))
+
+        return results[:limit]
+
+    def _partial_streets(self, city_key, street_key):
+        """
+        Street keys of a settlement containing street_key or contained in it, in index order
+        A substring shares all of its trigrams with the longer key, so only streets
+        whose trigram overlap is complete in one direction are compared
+        """
+        index = self._street_grams.get(city_key)
+        if index is None:
+            keys = list(self.streets.get(city_key, {}))
+            postings = {}
+            for position, key in enumerate(keys):
+                for gram in _grams(key):
+                    postings.setdefault(gram, []).append(position)
+            index = self._street_grams[city_key] = (keys, postings)
+        keys, postings = index
+
+        grams = _grams(street_key)
+        shared = {}
+        for gram in grams:
+            for position in postings.get(gram, ()):
+                shared[position] = shared.get(position, 0) + 1
+        matches = []
+        for position in sorted(shared):
+            key = keys[position]
+            if ((shared[position] == len(grams) and street_key in key)
+                    or (len(key) > 3 and shared[position] == len(_grams(key)) and key in street_key)):
+                matches.append(key)
+        return matches
+
+
+def read_geojson_features(path):
+    """
+    Features of a GeoJSON FeatureCollection or GeoJSON sequence file, one at a time
+    (shared with settlement_boundaries.py)
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.endswith(GEOJSON_SEQUENCE_SUFFIXES):
+            # One feature per line (RS-prefixed lines from osmium are accepted)
+            for line in f:
+                line = line.strip('\x1e \n')
+                if line:
+                    yield json.loads(line)
+        else:
+            yield from json.load(f).get('features', [])
+
+
+def _centroid(geometry):
+    """(lon, lat) of a GeoJSON geometry, averaging all its vertices"""
+    coords = geometry.get('coordinates')
+    if geometry.get('type') == 'Point':
+        return coords
+    flat = []
+
+    def walk(c):
+        if c and isinstance(c[0], (int, float)):
+            flat.append(c)
+        elif c and len(c) > 1 and isinstance(c[0][0], (int, float)) and c[0] == c[-1]:
+            # Closed ring - the repeated first vertex would bias the average
+            flat.extend(c[:-1])
+        else:
+            for sub in c or []:
+                walk(sub)
+    walk(coords)
+    if not flat:
+        return None
+    return (sum(p[0] for p in flat) / len(flat), sum(p[1] for p in flat) / len(flat))
+
+
+def _address_result(lat, lon, city, street, number):
+    parts = [p for p in (number, street, city, 'България') if p]
+    return {
+        'lat': lat,
+        'lon': lon,
+        'display_name': ', '.join(parts),
+        'address': {'city': city, 'road': street, 'house_number': number},
+        'osm_type': 'node',
+        'class': 'building' if number else 'highway',
+        'type': 'house' if number else 'residential',
+    }
+
+
+def _poi_result(name, lat, lon, amenity, city, street, number):
+    parts = [p for p in (name, number, street, city, 'България') if p]
+    return {
+        'lat': lat,
+        'lon': lon,
+        'display_name': ', '.join(parts),
+        'address': {'city': city, 'road': street, 'house_number': number},
+        'osm_type': 'node',
+        'class': 'amenity',
+        'type': amenity or 'hospital',
+    }
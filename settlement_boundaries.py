@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+SETTLEMENT BOUNDARIES
+Local index of settlement and municipality polygons, used by UltimateGeocoder
+to check geometrically whether a candidate lies in the expected
+Населено място / Община instead of comparing city strings
+
+Built once from OSM administrative boundaries, e.g.
+  osmium tags-filter bulgaria-latest.osm.pbf r/boundary=administrative -o admin.osm.pbf
+  osmium export admin.osm.pbf -f geojsonseq -o admin.geojsonseq
+Features are classified by admin_level (7 = община, 8 = settlement land area,
+9 = Sofia district) or by an explicit `kind` property.
+
+Usage:
+  python ultimate_geocode.py --build-boundaries admin.geojsonseq
+  python ultimate_geocode.py --boundaries settlement_boundaries.json
+"""
+import json
+import logging
+import re
+
+import numpy as np
+
+from address_normalizer import canonical_text
+from local_gazetteer import read_geojson_features
+
+BOUNDARIES_FILE = 'settlement_boundaries.json'
+ADMIN_LEVEL_KINDS = {'7': 'municipality', '8': 'settlement', '9': 'settlement'}
+PLACE_KINDS = {'city', 'town', 'village', 'suburb', 'quarter'}
+
+# "Община Плевен", "Район Триадица", "Столична община" -> "плевен", "триадица", "столична"
+AREA_PREFIX_RE = re.compile(r'^(?:община|район|гр|с)\s+')
+AREA_SUFFIX_RE = re.compile(r'\s+община$')
+# Registry forms: "СОФИЯ 10 рн ТРИАДИЦА", "София Кв.Драгалевци"
+SOFIA_DISTRICT_RE = re.compile(r'^софия\s+\d+\s+рн\s+(.+)$')
+QUARTER_RE = re.compile(r'^(.+?)\s+(?:кв|жк)\s+.+$')
+
+
+def _area_key(name):
+    return AREA_SUFFIX_RE.sub('', AREA_PREFIX_RE.sub('', canonical_text(name)))
+
+
+def _lookup_keys(name, kind):
+    """Index keys to try for a registry value, most specific first"""
+    key = _area_key(name)
+    keys = [key]
+    district = SOFIA_DISTRICT_RE.match(key)
+    if district:
+        keys.append(district.group(1))
+        keys.append('софия')
+    quarter = QUARTER_RE.match(key)
+    if quarter:
+        keys.append(quarter.group(1))
+    if kind == 'municipality' and key.startswith('софия'):
+        # Sofia's districts all belong to Столична община
+        keys.append('столична')
+    return list(dict.fromkeys(keys))
+
+
+def _rings(geometry):
+    """Every ring of a (Multi)Polygon as an (n, 2) lon/lat array"""
+    if geometry.get('type') == 'Polygon':
+        polygons = [geometry['coordinates']]
+    elif geometry.get('type') == 'MultiPolygon':
+        polygons = geometry['coordinates']
+    else:
+        return []
+    return [np.asarray(ring, dtype=float)[:, :2] for polygon in polygons for ring in polygon if len(ring) >= 4]
+
+
+def _inside(rings, lon, lat):
+    """Even-odd ray casting over all rings, so holes and multipolygons just work"""
+    crossings = 0
+    for ring in rings:
+        x1, y1 = ring[:-1, 0], ring[:-1, 1]
+        x2, y2 = ring[1:, 0], ring[1:, 1]
+        straddles = (y1 > lat) != (y2 > lat)
+        if not straddles.any():
+            continue
+        x1, y1, x2, y2 = x1[straddles], y1[straddles], x2[straddles], y2[straddles]
+        crossings += int(np.count_nonzero(lon < x1 + (lat - y1) * (x2 - x1) / (y2 - y1)))
+    return crossings % 2 == 1
+
+
+class Area:
+    """One boundary: bounding box prefilter plus its rings"""
+
+    __slots__ = ('name', 'parent', 'bbox', 'rings')
+
+    def __init__(self, name, rings, parent=None):
+        self.name = name
+        self.parent = parent
+        self.rings = rings
+        points = np.vstack(rings)
+        self.bbox = (*points.min(axis=0), *points.max(axis=0))
+
+    def contains(self, lat, lng):
+        min_lon, min_lat, max_lon, max_lat = self.bbox
+        if not (min_lon <= lng <= max_lon and min_lat <= lat <= max_lat):
+            return False
+        return _inside(self.rings, lng, lat)
+
+    def representative_point(self):
+        outer = self.rings[0]
+        return outer[:-1, 1].mean(), outer[:-1, 0].mean()
+
+    def to_json(self):
+        return [self.name, self.parent, [ring.round(6).tolist() for ring in self.rings]]
+
+
+class BoundaryIndex:
+    """Settlement and municipality areas keyed by canonical name"""
+
+    def __init__(self):
+        # kind -> area key -> [Area, ...] (village names repeat across municipalities)
+        self.areas = {'settlement': {}, 'municipality': {}}
+
+    def add(self, kind, name, rings, parent=None):
+        if kind in self.areas and name and rings:
+            self.areas[kind].setdefault(_area_key(name), []).append(Area(name, rings, parent))
+
+    def add_geojson(self, path):
+        for feature in read_geojson_features(path):
+            props = feature.get('properties') or {}
+            kind = props.get('kind') or ADMIN_LEVEL_KINDS.get(str(props.get('admin_level', '')))
+            if kind is None and props.get('place') in PLACE_KINDS:
+                kind = 'settlement'
+            self.add(kind, props.get('name:bg') or props.get('name'), _rings(feature.get('geometry') or {}))
+
+    def assign_municipalities(self):
+        """Record the municipality of every settlement, to tell same-named villages apart"""
+        municipalities = [(key, area) for key, areas in self.areas['municipality'].items() for area in areas]
+        for areas in self.areas['settlement'].values():
+            for area in areas:
+                if area.parent is None:
+                    lat, lng = area.representative_point()
+                    area.parent = next((key for key, m in municipalities if m.contains(lat, lng)), None)
+
+    @classmethod
+    def build(cls, sources):
+        index = cls()
+        for path in sources:
+            index.add_geojson(path)
+            logging.info(f"Boundary source indexed: {path}")
+        index.assign_municipalities()
+        return index
+
+    def save(self, path=BOUNDARIES_FILE):
+        data = {kind: [area.to_json() for areas in by_key.values() for area in areas]
+                for kind, by_key in self.areas.items()}
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path=BOUNDARIES_FILE):
+        index = cls()
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        for kind, areas in data.items():
+            for name, parent, rings in areas:
+                index.add(kind, name, [np.asarray(ring, dtype=float) for ring in rings], parent)
+        return index
+
+    def stats(self):
+        return {kind: sum(len(a) for a in by_key.values()) for kind, by_key in self.areas.items()}
+
+    # === Lookup ===
+
+    def _candidates(self, kind, name, municipality=None):
+        for key in _lookup_keys(name, kind):
+            areas = self.areas[kind].get(key)
+            if areas:
+                if municipality and len(areas) > 1:
+                    parents = set(_lookup_keys(municipality, 'municipality'))
+                    areas = [a for a in areas if a.parent in parents] or areas
+                return areas
+        return None
+
+    def contains(self, kind, name, lat, lng, municipality=None):
+        """
+        Whether (lat, lng) lies in the named area: True/False, or None when
+        no boundary of that name is indexed
+        """
+        if not name:
+            return None
+        areas = self._candidates(kind, name, municipality)
+        if areas is None:
+            return None
+        return any(area.contains(lat, lng) for area in areas)
+
+    def match(self, city, municipality, lat, lng):
+        """
+        Geometric verdict for a candidate: True inside the settlement, False
+        outside the settlement or its municipality, None when neither is indexed
+        (or only the municipality confirms it, which says nothing about the city)
+        """
+        verdict = self.contains('settlement', city, lat, lng, municipality)
+        if verdict is not None:
+            return verdict
+        if self.contains('municipality', municipality, lat, lng) is False:
+            return False
+        return None
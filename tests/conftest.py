@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Keep ultimate_geocode's import-time basicConfig from appending to the repo's log file
+logging.basicConfig(handlers=[logging.NullHandler()], force=True)
+
+import ultimate_geocode as ug  # noqa: E402
+
+
+class FakeResponse:
+    def __init__(self, payload, status_code=200):
+        self.payload = payload
+        self.status_code = status_code
+        self.headers = {}
+
+    def json(self):
+        return self.payload
+
+
+class FakeSession:
+    """
+    Answers every Nominatim search with one hospital in `city`, Overpass with
+    nothing; every request fails with `status` when it is set (an outage)
+    """
+
+    def __init__(self, city='Плевен', lat='43.4170', lon='24.6067'):
+        self.city, self.lat, self.lon = city, lat, lon
+        self.status = None
+        self.calls = 0
+
+    def get(self, url, params=None, timeout=None):
+        self.calls += 1
+        if self.status:
+            return FakeResponse(None, self.status)
+        return FakeResponse([{
+            'lat': self.lat, 'lon': self.lon, 'class': 'amenity', 'type': 'hospital',
+            'display_name': f"МБАЛ, ул. Георги Кочев 8, {self.city}, България",
+            'address': {'road': 'ул. Георги Кочев', 'house_number': '8', 'city': self.city},
+        }])
+
+    def post(self, url, data=None, timeout=None):
+        self.calls += 1
+        if self.status:
+            return FakeResponse(None, self.status)
+        return FakeResponse({'elements': []})
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Run in an empty directory, so caches start empty and nothing lands in the repo"""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def geocoder(workdir):
+    geocoder = ug.UltimateGeocoder(rate_limits={'nominatim': 1000, 'overpass': 1000})
+    geocoder.session = FakeSession()
+    return geocoder
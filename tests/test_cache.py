@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+import json
+import sqlite3
+import time
+
+import ultimate_geocode as ug
+
+ADDRESS, CITY, OBLAST = 'ул. Георги Кочев 8', 'ГР.ПЛЕВЕН', 'Плевен'
+
+
+def _age(geocoder, key, days, scoring_version):
+    entry = geocoder.cache[key]
+    entry.update(cached_at=time.time() - days * 86400, scoring_version=scoring_version)
+    geocoder.cache[key] = entry
+    return entry['cached_at']
+
+
+def test_offline_rescore_keeps_entry_age(geocoder):
+    result = geocoder.geocode(ADDRESS, CITY, OBLAST)
+    assert result[0] is not None and geocoder.session.calls
+    key = geocoder.cache_key(ADDRESS, CITY, OBLAST)
+    cached_at = _age(geocoder, key, 170, ug.SCORING_VERSION - 1)
+
+    geocoder.offline = True
+    calls = geocoder.session.calls
+    rescored = geocoder.rescore_rows([(ADDRESS, CITY, OBLAST, '', None, None, None)])
+
+    assert rescored[0][:2] == result[:2]
+    assert geocoder.session.calls == calls
+    entry = geocoder.cache[key]
+    assert entry['scoring_version'] == ug.SCORING_VERSION
+    assert entry['cached_at'] == cached_at
+
+
+def test_timestamp_migration_runs_once(workdir):
+    conn = sqlite3.connect('cache.sqlite')
+    conn.execute('CREATE TABLE geocode_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+    conn.execute("INSERT INTO geocode_cache VALUES ('old', ?)", (json.dumps({'score': 90}),))
+    conn.commit()
+    conn.close()
+
+    store = ug.CacheStore('cache.sqlite', legacy_json=None)
+    assert 'cached_at' in store['old']
+    assert store.conn.execute('PRAGMA user_version').fetchone()[0] == ug.CACHE_SCHEMA_VERSION
+    # Written behind the store's back: a later startup must not scan for it again
+    store.conn.execute("INSERT INTO geocode_cache VALUES ('new', ?)", (json.dumps({'score': 90}),))
+    store.conn.close()
+
+    store = ug.CacheStore('cache.sqlite', legacy_json=None)
+    assert 'cached_at' not in store['new']
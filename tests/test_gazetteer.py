@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+import subprocess
+import sys
+from pathlib import Path
+
+import local_gazetteer as lg
+
+STREETS = ['ул. Александър Стамболийски', 'бул. Стефан Стамболов', 'ул. Васил Левски',
+           'ул. Левски', 'ул. Рокфелер', 'ул. Ген. Гурко', 'ул. Гурко']
+
+
+def gazetteer():
+    g = lg.LocalGazetteer()
+    for i, street in enumerate(STREETS):
+        g.add({'addr:city': 'Петрич', 'addr:street': street}, 41.39 + i / 1000, 23.2)
+    g.add({'addr:city': 'Сандански', 'addr:street': 'ул. Стамболийски'}, 41.56, 23.28)
+    return g
+
+
+def test_index_modules_do_not_import_geocoder():
+    check = ('import sys, local_gazetteer, settlement_boundaries; '
+             'sys.exit("ultimate_geocode" in sys.modules)')
+    subprocess.run([sys.executable, '-c', check], cwd=Path(__file__).resolve().parent.parent, check=True)
+
+
+def test_partial_street_match_is_indexed_per_settlement():
+    g = gazetteer()
+    city_key = lg.canonical_text('Петрич')
+    for query in ['Стамболийски', 'Стамболов', 'Левски', 'ул. Васил Левски 5', 'Ген. Гурко', 'Рокфелер 52',
+                  'Стам', 'Несъществуваща']:
+        street_key = lg._street_key(query)
+        scan = [k for k in g.streets[city_key] if street_key in k or (len(k) > 3 and k in street_key)]
+        assert g._partial_streets(city_key, street_key) == scan
+    results = g.search('Петрич', 'Стамболийски')
+    assert [r['address']['city'] for r in results] == ['Петрич']
+    assert results[0]['address']['road'] == 'ул. Александър Стамболийски'
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import shutil
+
+import ultimate_geocode as ug
+
+MULTI_ADDRESS = 'УЛ. РОКФЕЛЕР № 52; УЛ. СВОБОДА № 1, ЕТ. 3'
+MULTI_CITY = 'ГР.ПЕТРИЧ; ГР.САНДАНСКИ'
+OBLAST = 'Благоевград'
+
+
+def test_clean_city_cleans_every_part():
+    assert ug.clean_city(MULTI_CITY) == 'Петрич; Сандански'
+    assert ug.canonical_text(MULTI_CITY) == ug.canonical_text(ug.clean_city(MULTI_CITY))
+
+
+def test_clean_address_strips_only_trailing_premises():
+    assert ug.clean_address('бул. Стефан Стамболов №73 приземен етаж ет.1 и част от ет.2 '
+                            'от Терапевтичен корпус /блок 3/') == 'бул. Стефан Стамболов 73'
+    assert ug.clean_address('ул. Армейска № 13, вх. А, ет. 1') == 'ул. Армейска 13'
+    assert ug.clean_address('ул. Вход 3 ет.2 до аптеката') == 'ул. Вход 3 ет.2 до аптеката'
+
+
+def test_multi_city_rescore_hits_stored_key(geocoder):
+    geocoder.session.city = 'Петрич'
+    result = geocoder.geocode(MULTI_ADDRESS, MULTI_CITY, OBLAST)
+    assert result[0] is not None
+    key = geocoder.cache_key(MULTI_ADDRESS, MULTI_CITY, OBLAST)
+    assert key == geocoder.cache_key(ug.clean_address(MULTI_ADDRESS), ug.clean_city(MULTI_CITY), OBLAST)
+    entries = len(geocoder.cache)
+
+    geocoder.offline = True
+    rescored = geocoder.rescore_rows([(MULTI_ADDRESS, MULTI_CITY, OBLAST, '', None, None, None)])
+
+    assert rescored[0][:2] == result[:2]
+    assert len(geocoder.cache) == entries
+    assert geocoder.cache[key]['lat'] == result[0]
+
+
+def test_multi_address_outage_keeps_stale_winner(geocoder, monkeypatch):
+    monkeypatch.setattr(ug, 'MAX_RETRIES', 0)
+    geocoder.session.city = 'Петрич'
+    result = geocoder.geocode(MULTI_ADDRESS, MULTI_CITY, OBLAST)
+    # Only the cell's winner is left, and it expired a while ago
+    shutil.rmtree('response_cache')
+    key = geocoder.cache_key(MULTI_ADDRESS, MULTI_CITY, OBLAST)
+    entry = dict(geocoder.cache[key], cached_at=geocoder.cache[key]['cached_at'] - 365 * 86400)
+    geocoder.cache.conn.execute('DELETE FROM geocode_cache')
+    geocoder.cache.memory.clear()
+    geocoder.cache[key] = entry
+
+    geocoder.session.status = 503
+    assert geocoder.geocode(MULTI_ADDRESS, MULTI_CITY, OBLAST) == result
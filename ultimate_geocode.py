@@ -7,14 +7,39 @@ Combines multiple strategies for maximum accuracy:
 3. Result validation and scoring
 4. Smart caching with quality indicators
 """
+import numpy as np
 import pandas as pd
 import requests
 import time
 import json
 import os
+import hashlib
+import sqlite3
 import re
 import logging
-from urllib.parse import quote
+import functools
+import argparse
+import threading
+import csv
+import shutil
+import random
+import email.utils
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import quote, urlsplit
+from requests.adapters import HTTPAdapter
+
+from address_normalizer import (
+    HOSPITAL_NAME_RE, NAME_TOKEN_RE, LEGAL_FORMS, POI_NAME_SIMILARITY, clean_city, clean_address,
+    split_addresses, row_settlements, canonical_text, NameIndex,
+)
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
 
 logging.basicConfig(
     filename='ultimate_geocode.log',
@@ -23,47 +48,906 @@ logging.basicConfig(
     encoding='utf-8'
 )
 
+# Requests per second allowed for each backend. Every backend has its own
+# bucket, so throughput is capped by the provider policies rather than by
+# fixed sleeps after each call.
+RATE_LIMITS = {
+    'nominatim': 1.0,
+    'overpass': 0.5,
+}
+
+# Provider endpoints; override for a self-hosted mirror or a local stand-in
+PROVIDER_URLS = {
+    'nominatim': 'https://nominatim.openstreetmap.org/search',
+    'overpass': 'https://overpass-api.de/api/interpreter',
+}
+
+# Seconds the primary search provider gets before a secondary is asked too
+HEDGE_AFTER = 1.0
+
+# Bump whenever _score_result/score_results_batch change: stored winners with
+# an older stamp become stale and are re-scored (from the raw response cache)
+SCORING_VERSION = 1
+# Data migrations applied to ultimate_cache.sqlite (PRAGMA user_version)
+CACHE_SCHEMA_VERSION = 1
+# Winner cache lifetimes; failures expire sooner since OSM keeps improving
+POSITIVE_TTL_DAYS = 180
+NEGATIVE_TTL_DAYS = 14
+
+
+# Transient provider failures: retried with jittered exponential backoff
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_RETRIES = 3
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 30.0
+# AIMD pacing: +5% of the policy rate per success, halve on throttling/errors
+AIMD_INCREASE = 0.05
+AIMD_DECREASE = 0.5
+# Circuit breaker: consecutive failed attempts before a backend is skipped
+BREAKER_THRESHOLD = 5
+BREAKER_RESET = 60.0
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter with AIMD pacing
+    The rate starts at the policy maximum, is halved when the server pushes
+    back (at most once per refill interval, however many concurrent calls
+    were refused) and creeps back up on every success; Retry-After sets a
+    not-before deadline that every caller of the backend waits out
+    """
+
+    def __init__(self, rate, capacity=1, min_rate=None):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate or rate / 16
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        # No token is handed out (or refilled) before this monotonic time
+        self.not_before = 0.0
+        self.decreased_at = float('-inf')
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        start = max(self.updated, self.not_before)
+        if now > start:
+            self.tokens = min(self.capacity, self.tokens + (now - start) * self.rate)
+            self.updated = now
+        return now
+
+    def acquire(self):
+        """Reserve one token, sleeping until it becomes available"""
+        with self.lock:
+            now = self._refill()
+            # Reserve the token up front so concurrent callers queue in order
+            self.tokens -= 1
+            wait = max(0.0, self.not_before - now) + (-self.tokens / self.rate if self.tokens < 0 else 0)
+        while wait > 0:
+            time.sleep(wait)
+            # A Retry-After that arrived while this caller slept still applies
+            with self.lock:
+                wait = self.not_before - time.monotonic()
+
+    def succeeded(self):
+        with self.lock:
+            self._refill()
+            self.rate = min(self.max_rate, self.rate + self.max_rate * AIMD_INCREASE)
+
+    def throttled(self, retry_after=None):
+        """Back off after a 429/5xx/connection error, pausing for retry_after seconds if given"""
+        with self.lock:
+            now = self._refill()
+            # Concurrent refusals of one throttle window count as a single signal
+            if now - self.decreased_at >= 1 / self.rate:
+                self.rate = max(self.min_rate, self.rate * AIMD_DECREASE)
+                self.decreased_at = now
+            if retry_after:
+                self.not_before = max(self.not_before, now + retry_after)
+
+
+class CircuitBreaker:
+    """
+    Per-backend breaker: after `threshold` consecutive failures the backend is
+    skipped for `reset_timeout` seconds, then a single probe request decides
+    whether it closes again
+    """
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, reset_timeout=BREAKER_RESET):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        # Thread sending the half-open probe
+        self.prober = None
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'half_open' if self.probing else 'open'
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.probing or time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.probing = True
+            self.prober = threading.get_ident()
+            return True
+
+    def succeeded(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def release(self):
+        """End this thread's probe if it ended without a verdict, so the next call can probe"""
+        with self.lock:
+            if self.probing and self.prober == threading.get_ident():
+                self.probing = False
+
+    def failed(self):
+        """Count a failure, returns True when this failure opened the breaker"""
+        with self.lock:
+            self.failures += 1
+            was_closed = self.opened_at is None
+            if self.probing or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+                self.probing = False
+                return was_closed
+            return False
+
+
+def _retry_after(resp):
+    """Seconds requested by a Retry-After header (delta or HTTP date), or None"""
+    value = resp.headers.get('Retry-After') if resp is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _backoff(attempt):
+    """Full-jitter exponential backoff for retry number `attempt` (0-based)"""
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+class NominatimProvider:
+    """Nominatim-compatible /search endpoint (public OSM instance or self-hosted)"""
+
+    def __init__(self, name, url, rate=1.0):
+        self.name = name
+        self.url = url
+        self.rate = rate
+        # Raw response cache namespace; the public instance keeps the historical one
+        self.endpoint = 'nominatim/search' if name == 'nominatim' else f"{name}/search"
+
+    def search_params(self, query, limit):
+        return {
+            'q': query,
+            'format': 'json',
+            'addressdetails': 1,
+            'limit': limit,
+            'countrycodes': 'bg',
+            'extratags': 1,  # Get OSM tags
+            'namedetails': 1,  # Get name variations
+            'dedupe': 0  # Don't merge similar results
+        }
+
+    def structured_params(self, street, city, house_number=None):
+        params = {
+            'format': 'json',
+            'addressdetails': 1,
+            'limit': 10,
+            'country': 'Bulgaria',
+            'countrycodes': 'bg',
+            'extratags': 1,
+            'namedetails': 1
+        }
+        if city:
+            params['city'] = city
+        if street and house_number:
+            params['street'] = f"{street} {house_number}"
+        elif street:
+            params['street'] = street
+        return params
+
+    def parse(self, payload):
+        return payload if isinstance(payload, list) else []
+
+
+class PhotonProvider:
+    """Photon /api endpoint: free-text only, GeoJSON answers mapped to Nominatim's shape"""
+
+    # Bulgaria, minLon,minLat,maxLon,maxLat
+    BBOX = '22.35,41.23,28.61,44.22'
+    OSM_TYPES = {'N': 'node', 'W': 'way', 'R': 'relation'}
+
+    def __init__(self, name, url, rate=1.0):
+        self.name = name
+        self.url = url
+        self.rate = rate
+        self.endpoint = f"{name}/api"
+
+    def search_params(self, query, limit):
+        return {'q': query, 'limit': limit, 'bbox': self.BBOX}
+
+    def structured_params(self, street, city, house_number=None):
+        return None
+
+    def parse(self, payload):
+        results = []
+        for feature in (payload or {}).get('features', []):
+            props = feature.get('properties', {})
+            lon, lat = feature.get('geometry', {}).get('coordinates', (None, None))
+            if lat is None:
+                continue
+            city = props.get('city') or props.get('town') or props.get('village') or ''
+            street_part = ' '.join(p for p in (props.get('street'), props.get('housenumber')) if p)
+            parts = [props.get('name'), street_part, city, props.get('country')]
+            results.append({
+                'lat': str(lat),
+                'lon': str(lon),
+                'display_name': ', '.join(p for p in parts if p),
+                'address': {'city': city, 'road': props.get('street', ''),
+                            'house_number': props.get('housenumber', '')},
+                'osm_type': self.OSM_TYPES.get(props.get('osm_type'), ''),
+                'osm_id': props.get('osm_id', ''),
+                'class': props.get('osm_key', ''),
+                'type': props.get('osm_value', ''),
+            })
+        return results
+
+
+PROVIDER_TYPES = {'nominatim': NominatimProvider, 'photon': PhotonProvider}
+
+
+def parse_provider(spec):
+    """Provider from 'name=kind:url[@rate]', e.g. 'local=nominatim:http://localhost:8080/search@20'"""
+    name, _, rest = spec.partition('=')
+    kind, _, url = rest.partition(':')
+    rate = 1.0
+    head, sep, tail = url.rpartition('@')
+    # '@' in the host part ('http://user@host/search') is not a rate
+    if sep and '/' not in tail:
+        try:
+            rate, url = float(tail), head
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"Bad provider rate '{tail}' in '{spec}', expected a number")
+        if not rate > 0:
+            raise argparse.ArgumentTypeError(f"Bad provider rate '{tail}' in '{spec}', expected a positive number")
+    parts = urlsplit(url)
+    if not name or kind not in PROVIDER_TYPES or parts.scheme not in ('http', 'https') or not parts.netloc:
+        raise argparse.ArgumentTypeError(f"Bad provider spec '{spec}', expected name=kind:url[@rate] "
+                                         f"with kind in {sorted(PROVIDER_TYPES)} and an http(s) url")
+    return PROVIDER_TYPES[kind](name, url, rate)
+
+
+# Address patterns, compiled once
+# Street numbers like "123", "123А", "123-125", "123/1"
+STREET_NUMBER_RE = re.compile(r'\b(\d+[А-Яа-яA-Za-z]?(?:[-/]\d+[А-Яа-яA-Za-z]?)?)\s*$')
+TRAILING_NUMBER_RE = re.compile(r'\s+\d+.*$')
+NON_DIGIT_RE = re.compile(r'[^\d]')
+
+
+class ResponseCache:
+    """
+    Content-addressed store of raw provider responses
+    Keyed by endpoint + normalized query params, one JSON file per response
+    """
+
+    def __init__(self, root='response_cache'):
+        self.root = root
+
+    @staticmethod
+    def key(endpoint, params):
+        # Normalize values so whitespace/type differences hash identically
+        normalized = {str(k): ' '.join(str(v).split()) for k, v in params.items()}
+        blob = json.dumps([endpoint, normalized], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], f"{key}.json")
+
+    def get(self, endpoint, params, newer_than=None):
+        """Return the cached response payload or None (also when not newer than `newer_than`)"""
+        path = self._path(self.key(endpoint, params))
+        try:
+            if newer_than is not None and os.path.getmtime(path) <= newer_than:
+                return None
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)['response']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def put(self, endpoint, params, payload):
+        key = self.key(endpoint, params)
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temp file first so a crash never leaves a truncated entry
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'endpoint': endpoint, 'params': params, 'response': payload},
+                      f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+
+class CacheStore:
+    """
+    Winner cache backed by SQLite in WAL mode
+    Each geocode is a single-record upsert and reads are per key, so neither
+    writes nor startup scale with the size of the cache. A bounded LRU in
+    front of it serves repeated lookups without touching SQLite.
+    Entries carry cached_at/scoring_version stamps; failures are stored too,
+    as {'failed': True, 'lat': None, ...}
+    """
+
+    def __init__(self, path='ultimate_cache.sqlite', legacy_json='ultimate_cache.json', key_func=None,
+                 memory_size=10000):
+        self.path = path
+        # Maps legacy 'address||city||oblast' keys to the current key format
+        self.key_func = key_func
+        # key -> value (None for known misses), most recently used last
+        self.memory = OrderedDict()
+        self.memory_size = memory_size
+        # Autocommit: every upsert is its own durable transaction
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS geocode_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL)'
+            )
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS strategy_stats '
+                '(strategy TEXT PRIMARY KEY, attempts INTEGER NOT NULL, wins INTEGER NOT NULL)'
+            )
+        
+        self._migrate()
+        
+        # First run after the JSON era - carry the old cache over
+        if legacy_json and os.path.exists(legacy_json) and len(self) == 0:
+            count = self.import_json(legacy_json)
+            logging.info(f"Imported {count} entries from {legacy_json} into {path}")
+
+    def _migrate(self):
+        """One-time data migrations, tracked in PRAGMA user_version so startup never rescans the table"""
+        with self.lock:
+            version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+            if version >= CACHE_SCHEMA_VERSION:
+                return
+            self.conn.execute('BEGIN')
+            if version < 1:
+                # Entries from before timestamps existed start their TTL now
+                self.conn.execute(
+                    "UPDATE geocode_cache SET value = json_set(value, '$.cached_at', ?) "
+                    "WHERE json_extract(value, '$.cached_at') IS NULL", (time.time(),)
+                )
+            self.conn.execute(f'PRAGMA user_version = {CACHE_SCHEMA_VERSION}')
+            self.conn.execute('COMMIT')
+
+    def import_json(self, path):
+        """Import a legacy ultimate_cache.json file, returns number of entries inserted"""
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        
+        # Legacy keys that now collapse to one key keep the best-scored entry;
+        # entries without a timestamp start their TTL now
+        now = time.time()
+        entries = {}
+        for key, value in data.items():
+            value.setdefault('cached_at', now)
+            key = self.key_func(key) if self.key_func else key
+            if key not in entries or value.get('score', 0) > entries[key].get('score', 0):
+                entries[key] = value
+        
+        with self.lock:
+            # INSERT OR IGNORE skips keys already stored, so count actual changes
+            before = self.conn.total_changes
+            self.conn.execute('BEGIN')
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO geocode_cache (key, value) VALUES (?, ?)',
+                ((key, json.dumps(value, ensure_ascii=False)) for key, value in entries.items())
+            )
+            self.conn.execute('COMMIT')
+            return self.conn.total_changes - before
+
+    def _remember(self, key, value):
+        # Caller holds self.lock
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                value = self.memory[key]
+            else:
+                row = self.conn.execute('SELECT value FROM geocode_cache WHERE key = ?', (key,)).fetchone()
+                value = json.loads(row[0]) if row else None
+                self._remember(key, value)
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.conn.execute(
+                'INSERT INTO geocode_cache (key, value) VALUES (?, ?) '
+                'ON CONFLICT(key) DO UPDATE SET value = excluded.value',
+                (key, json.dumps(value, ensure_ascii=False))
+            )
+            self._remember(key, value)
+
+    def invalidate(self, provider=None, below_score=None, failed=False, before_version=None):
+        """
+        Delete matching entries (all filters must match), returns how many
+        provider matches by prefix, so 'overpass' also drops 'overpass_lowconf'
+        """
+        clauses, params = [], []
+        if provider:
+            clauses.append("json_extract(value, '$.provider') LIKE ?")
+            params.append(f"{provider}%")
+        if below_score is not None:
+            clauses.append("COALESCE(json_extract(value, '$.score'), 0) < ?")
+            params.append(below_score)
+        if failed:
+            clauses.append("json_extract(value, '$.failed') = 1")
+        if before_version is not None:
+            clauses.append("COALESCE(json_extract(value, '$.scoring_version'), 1) < ?")
+            params.append(before_version)
+        where = ' AND '.join(clauses) or '1'
+        with self.lock:
+            deleted = self.conn.execute(f'DELETE FROM geocode_cache WHERE {where}', params).rowcount
+            self.memory.clear()
+        return deleted
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM geocode_cache').fetchone()[0]
+
+    def load_strategy_stats(self):
+        """Return {strategy: (attempts, wins)}"""
+        with self.lock:
+            rows = self.conn.execute('SELECT strategy, attempts, wins FROM strategy_stats').fetchall()
+        return {strategy: (attempts, wins) for strategy, attempts, wins in rows}
+
+    def record_strategy_stats(self, attempted, winner):
+        with self.lock:
+            self.conn.executemany(
+                'INSERT INTO strategy_stats (strategy, attempts, wins) VALUES (?, 1, ?) '
+                'ON CONFLICT(strategy) DO UPDATE SET attempts = attempts + 1, wins = wins + excluded.wins',
+                ((strategy, int(strategy == winner)) for strategy in attempted)
+            )
+
+
+class QueryPlanner:
+    """
+    Orders geocoding strategies by historical hit rate and decides when to stop
+    A strategy scores a hit when it produced the candidate that was selected
+    """
+
+    def __init__(self, store, confidence_threshold=80):
+        self.store = store
+        self.confidence_threshold = confidence_threshold
+        self.stats = store.load_strategy_stats()
+        self.lock = threading.Lock()
+
+    def hit_rate(self, strategy):
+        attempts, wins = self.stats.get(strategy, (0, 0))
+        # Laplace smoothing - untried strategies start at 0.5
+        return (wins + 1) / (attempts + 2)
+
+    def order(self, strategies):
+        """Best strategies first; ties keep the default order"""
+        return sorted(strategies, key=self.hit_rate, reverse=True)
+
+    def should_stop(self, candidates):
+        return any(c['score'] >= self.confidence_threshold for c in candidates)
+
+    def record(self, attempted, winner):
+        with self.lock:
+            for strategy in attempted:
+                attempts, wins = self.stats.get(strategy, (0, 0))
+                self.stats[strategy] = (attempts + 1, wins + (strategy == winner))
+        self.store.record_strategy_stats(attempted, winner)
+
+
+# Histogram bucket bounds (seconds) for provider and strategy latency
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class MetricsRegistry:
+    """
+    In-process counters and histograms, fed by geocoder events
+    Dumped as JSON at the end of a run or scraped in Prometheus text format
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counters = {}
+        # (name, labels) -> [bucket counts..., +Inf count, sum]
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            hist = self.histograms.setdefault(key, [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist[i] += 1
+                    break
+            else:
+                hist[len(self.buckets)] += 1
+            hist[-1] += value
+
+    def __call__(self, event, fields):
+        """Geocoder observer: turns fetch/strategy/row events into metrics"""
+        if event == 'fetch':
+            self.inc('geocode_fetch_total', backend=fields['backend'],
+                     cache='hit' if fields['cached'] else 'miss', status=str(fields['status'] or 'cached'))
+            if not fields['cached']:
+                self.observe('geocode_fetch_seconds', fields['seconds'], backend=fields['backend'])
+        elif event == 'strategy':
+            self.inc('geocode_strategy_total', strategy=fields['strategy'])
+            self.inc('geocode_strategy_results_total', fields['results'], strategy=fields['strategy'])
+            self.observe('geocode_strategy_seconds', fields['seconds'], strategy=fields['strategy'])
+        elif event == 'hedge':
+            self.inc('geocode_hedges_total', provider=fields['provider'])
+        elif event == 'row':
+            self.inc('geocode_rows_total', outcome=fields['outcome'])
+            if fields.get('strategy'):
+                self.inc('geocode_winner_total', strategy=fields['strategy'])
+            self.inc('geocode_requests_total', fields.get('requests', 0))
+
+    def value(self, name, **labels):
+        """Current value of a counter (0 if never incremented)"""
+        with self.lock:
+            return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def strategy_summary(self):
+        """strategy -> (runs, seconds spent, wins)"""
+        summary = {}
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                if name in ('geocode_strategy_total', 'geocode_winner_total'):
+                    runs, seconds, wins = summary.get(dict(labels)['strategy'], (0, 0.0, 0))
+                    if name == 'geocode_strategy_total':
+                        runs = value
+                    else:
+                        wins = value
+                    summary[dict(labels)['strategy']] = (runs, seconds, wins)
+            for (name, labels), hist in self.histograms.items():
+                if name == 'geocode_strategy_seconds':
+                    runs, _, wins = summary.get(dict(labels)['strategy'], (0, 0.0, 0))
+                    summary[dict(labels)['strategy']] = (runs, hist[-1], wins)
+        return summary
+
+    def snapshot(self):
+        """Plain-dict view: counters and histograms keyed by name and labels"""
+        def label_key(name, labels):
+            return name + ('{' + ','.join(f"{k}={v}" for k, v in labels) + '}' if labels else '')
+        with self.lock:
+            counters = {label_key(n, l): v for (n, l), v in sorted(self.counters.items())}
+            histograms = {
+                label_key(n, l): {
+                    'count': sum(h[:-1]),
+                    'sum': round(h[-1], 6),
+                    'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'], h[:-1])),
+                }
+                for (n, l), h in sorted(self.histograms.items())
+            }
+        return {'counters': counters, 'histograms': histograms}
+
+    def render(self):
+        """Prometheus text exposition format"""
+        def fmt(labels, **extra):
+            pairs = list(labels) + list(extra.items())
+            return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}' if pairs else ''
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{name}{fmt(labels)} {value}")
+            for (name, labels), hist in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(list(self.buckets) + ['+Inf'], hist[:-1]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{fmt(labels, le=bound)} {cumulative}")
+                lines.append(f"{name}_sum{fmt(labels)} {hist[-1]:.6f}")
+                lines.append(f"{name}_count{fmt(labels)} {cumulative}")
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(), f, ensure_ascii=False, indent=2)
+
+    def serve(self, port, host='127.0.0.1'):
+        """Expose /metrics (Prometheus) and /metrics.json on a background thread"""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.startswith('/metrics.json'):
+                    body, ctype = json.dumps(registry.snapshot(), ensure_ascii=False), 'application/json'
+                elif self.path.startswith('/metrics'):
+                    body, ctype = registry.render(), 'text/plain; version=0.0.4'
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', f"{ctype}; charset=utf-8")
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+class TraceWriter:
+    """Geocoder observer writing one JSON span per fetch, strategy and row (JSONL)"""
+
+    def __init__(self, path):
+        self.path = path
+        self.handle = open(path, 'a', encoding='utf-8')
+        self.lock = threading.Lock()
+
+    def __call__(self, event, fields):
+        span = {'ts': round(time.time(), 3), 'span': event}
+        for key, value in fields.items():
+            if key == 'seconds':
+                span['latency_ms'] = round(value * 1000, 2)
+            else:
+                span[key] = value
+        line = json.dumps(span, ensure_ascii=False)
+        with self.lock:
+            self.handle.write(line + '\n')
+
+    def close(self):
+        with self.lock:
+            self.handle.close()
+
+
+# Provider label stored with a candidate, by strategy (default: nominatim_free)
+STRATEGY_PROVIDERS = {
+    'structured': 'nominatim_structured',
+    'structured_street': 'nominatim_structured',
+    'local': 'local_gazetteer',
+}
+
+
+class RequestBudget:
+    """
+    Request and wall-clock allowance shared by the rows of an --improve run
+    Spending is booked after each strategy, so concurrent rows can overshoot
+    by the few requests already in flight
+    """
+
+    def __init__(self, requests, seconds=None):
+        self.requests = requests
+        self.remaining = requests
+        self.deadline = time.monotonic() + seconds if seconds else None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        return self.remaining > 0 and (self.deadline is None or time.monotonic() < self.deadline)
+
+    def spend(self, requests):
+        with self._lock:
+            self.remaining -= requests
+
+    @property
+    def spent(self):
+        return self.requests - self.remaining
+
+
 class UltimateGeocoder:
-    def __init__(self):
-        self.cache = self._load_cache()
+    def __init__(self, rate_limits=None, pool_size=10, offline=False, confidence_threshold=80,
+                 gazetteer=None, urls=None, providers=None, hedge_after=HEDGE_AFTER,
+                 positive_ttl_days=POSITIVE_TTL_DAYS, negative_ttl_days=NEGATIVE_TTL_DAYS, boundaries=None):
+        self.cache = CacheStore(key_func=lambda key: self.cache_key(*key.rsplit('||', 2)))
+        self.planner = QueryPlanner(self.cache, confidence_threshold)
+        self.positive_ttl = positive_ttl_days * 86400
+        self.negative_ttl = negative_ttl_days * 86400
+        self.responses = ResponseCache()
+        # Offline mode answers only from the raw response cache (and the gazetteer)
+        self.offline = offline
+        # Optional LocalGazetteer, consulted before any provider request
+        self.gazetteer = gazetteer
+        # Optional BoundaryIndex; candidates are then checked against the settlement polygon
+        self.boundaries = boundaries
+        # Settlement -> Overpass POIs, filled once per settlement
+        self._poi_index = {}
+        # Settlement -> (NameIndex over its POIs, hospital-named POIs)
+        self._poi_names = {}
+        self._poi_lock = threading.Lock()
+        self._poi_city_locks = {}
+        # Per-thread counters for the row currently being geocoded
+        self._local = threading.local()
         self.session = requests.Session()
         self.session.headers.update({'User-Agent': 'HospitalGeocoder/2.0'})
-        
-    def _load_cache(self):
-        if os.path.exists('ultimate_cache.json'):
-            with open('ultimate_cache.json', 'r', encoding='utf-8') as f:
-                return json.load(f)
-        return {}
+        # Enough pooled connections for every worker thread
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.urls = dict(PROVIDER_URLS, **(urls or {}))
+        # Search providers in priority order; the first one is the primary
+        self.providers = providers or [
+            NominatimProvider('nominatim', self.urls['nominatim'], RATE_LIMITS['nominatim'])]
+        self.hedge_after = hedge_after
+        self._hedge_pool = (ThreadPoolExecutor(max_workers=pool_size * len(self.providers))
+                            if len(self.providers) > 1 else None)
+        # One bucket and breaker per backend
+        limits = dict(RATE_LIMITS, **{p.name: p.rate for p in self.providers})
+        limits.update(rate_limits or {})
+        self.limiters = {backend: TokenBucket(rate) for backend, rate in limits.items()}
+        self.breakers = {backend: CircuitBreaker() for backend in limits}
+        # Callables observer(event, fields), told about every fetch and strategy run
+        self.observers = []
+    
+    def _notify(self, event, **fields):
+        if not self.observers:
+            return
+        fields.setdefault('row', getattr(self._local, 'row', None))
+        for observer in self.observers:
+            observer(event, fields)
     
-    def _save_cache(self):
-        with open('ultimate_cache.json', 'w', encoding='utf-8') as f:
-            json.dump(self.cache, f, ensure_ascii=False, indent=2)
+    def _notify_row(self, outcome, strategy, score, requests_used):
+        started = getattr(self._local, 'started', None)
+        self._notify('row', outcome=outcome, strategy=strategy, score=score, requests=requests_used,
+                     seconds=time.perf_counter() - started if started else 0.0)
+    
+    def _begin_row(self, cache_key, newer_than=None):
+        """Reset the per-thread counters for the row about to be geocoded"""
+        self._local.row = cache_key
+        self._local.started = time.perf_counter()
+        self._local.requests = 0
+        self._local.response_hits = 0
+        self._local.fetch_errors = 0
+        self._local.newer_than = newer_than
+    
+    def _fetch(self, backend, endpoint, url, params, method='GET', timeout=15):
+        """Provider call through the raw response cache, returns parsed JSON or None"""
+        cached = self.responses.get(endpoint, params, getattr(self._local, 'newer_than', None))
+        if cached is not None:
+            self._local.response_hits = getattr(self._local, 'response_hits', 0) + 1
+            self._notify('fetch', backend=backend, query=_describe_query(params), cached=True,
+                         status=None, seconds=0.0, results=_payload_size(cached))
+            return cached
+        if self.offline:
+            return None
+        
+        limiter, breaker = self.limiters[backend], self.breakers[backend]
+        query = _describe_query(params)
+        for attempt in range(MAX_RETRIES + 1):
+            if not breaker.allow():
+                self._notify('fetch', backend=backend, query=query, cached=False,
+                             status='circuit_open', seconds=0.0, results=0, attempt=attempt)
+                self._local.fetch_errors = getattr(self._local, 'fetch_errors', 0) + 1
+                return None
+            
+            try:
+                limiter.acquire()
+                self._local.requests = getattr(self._local, 'requests', 0) + 1
+                started = time.perf_counter()
+                try:
+                    if method == 'POST':
+                        resp = self.session.post(url, data=params, timeout=timeout)
+                    else:
+                        resp = self.session.get(url, params=params, timeout=timeout)
+                    status = resp.status_code
+                except requests.RequestException as e:
+                    resp, status = None, type(e).__name__
+                seconds = time.perf_counter() - started
+
+                if status == 200:
+                    try:
+                        payload = resp.json()
+                    except ValueError:
+                        # Truncated or HTML error page behind a 200 - a failure like a 5xx
+                        resp, status = None, 'invalid_json'
+                if status == 200:
+                    limiter.succeeded()
+                    breaker.succeeded()
+                    self._notify('fetch', backend=backend, query=query, cached=False,
+                                 status=status, seconds=seconds, results=_payload_size(payload), attempt=attempt)
+                    self.responses.put(endpoint, params, payload)
+                    return payload
+
+                self._notify('fetch', backend=backend, query=query, cached=False,
+                             status=status, seconds=seconds, results=0, attempt=attempt)
+                if resp is not None and status not in RETRY_STATUSES:
+                    # Permanent (4xx) - retrying the same request cannot help, but the
+                    # backend answered, so it is healthy as far as the breaker is concerned
+                    breaker.succeeded()
+                    logging.warning(f"{backend} HTTP {status} for {query[:80]}")
+                    return None
+
+                retry_after = _retry_after(resp)
+                limiter.throttled(retry_after)
+                if breaker.failed():
+                    logging.warning(f"{backend} circuit opened after {breaker.failures} failures "
+                                    f"(retry in {breaker.reset_timeout:.0f}s)")
+            finally:
+                # A probe that raised must not leave the breaker half-open forever
+                breaker.release()
+            if attempt < MAX_RETRIES and not retry_after:
+                # With Retry-After the limiter already holds every caller back
+                time.sleep(_backoff(attempt))
+        
+        logging.warning(f"{backend} gave up after {MAX_RETRIES + 1} attempts ({status}): {query[:80]}")
+        self._local.fetch_errors = getattr(self._local, 'fetch_errors', 0) + 1
+        return None
     
     def _extract_street_number(self, address):
         """Extract street number from address"""
-        # Match patterns like "123", "123А", "123-125", "123/1"
-        match = re.search(r'\b(\d+[А-Яа-яA-Za-z]?(?:[-/]\d+[А-Яа-яA-Za-z]?)?)\s*$', address)
-        return match.group(1) if match else None
+        return extract_street_number(address)
     
     def _extract_street_name(self, address):
         """Extract clean street name without number"""
-        # Remove prefixes
-        addr = address.replace('ул.', '').replace('бул.', '').replace('жк', '').strip()
-        # Remove number
-        addr = re.sub(r'\s+\d+.*$', '', addr).strip()
-        return addr
+        return extract_street_name(address)
     
-    def _score_result(self, result, address, city, street_number):
+    def _geo_match(self, result, city, municipality=None):
+        """Boundary verdict for a candidate: True/False, None without an indexed boundary"""
+        if self.boundaries is None:
+            return None
+        try:
+            lat, lng = float(result['lat']), float(result['lon'])
+        except (KeyError, TypeError, ValueError):
+            return None
+        return self.boundaries.match(city, municipality, lat, lng)
+    
+    def _score_result(self, result, address, city, street_number, municipality=None):
         """Score geocoding result quality (0-100) with enhanced precision"""
         score = 0
         display = result.get('display_name', '').lower()
         addr_data = result.get('address', {})
+        features = _score_features(address, city, street_number)
+        
+        # 0. Outside the settlement's boundary - rejected, whatever the strings say
+        geo_match = self._geo_match(result, city, municipality)
+        if geo_match is False:
+            return 0
         
         # 1. Exact city match (30 points) - STRICT
-        city_lower = city.lower()
+        city_lower = features['city_lower']
         result_city = (addr_data.get('city') or addr_data.get('town') or addr_data.get('village') or '').lower()
         
-        if result_city == city_lower:
+        if geo_match or result_city == city_lower:
             score += 30
         elif city_lower in display:
             score += 20  # Partial match in display name
@@ -78,7 +962,7 @@ class UltimateGeocoder:
             if street_number == result_number:
                 score += 40
             # Normalize and compare (remove letters, slashes)
-            elif re.sub(r'[^\d]', '', street_number) == re.sub(r'[^\d]', '', result_number):
+            elif features['number_digits'] == NON_DIGIT_RE.sub('', result_number):
                 score += 35
             # Number appears in display
             elif street_number in display:
@@ -90,12 +974,10 @@ class UltimateGeocoder:
             score -= 10
         
         # 3. Street name match (25 points) - ENHANCED
-        street_name = self._extract_street_name(address)
+        street_lower = features['street_lower']
         result_road = (addr_data.get('road') or addr_data.get('street') or '').lower()
         
-        if street_name and len(street_name) > 3:
-            street_lower = street_name.lower()
-            
+        if street_lower:
             # Exact match in road field
             if street_lower in result_road or result_road in street_lower:
                 score += 25
@@ -104,8 +986,7 @@ class UltimateGeocoder:
                 score += 15
             else:
                 # Check word-by-word match
-                words = [w for w in street_name.split() if len(w) > 3]
-                matches = sum(1 for w in words if w.lower() in display or w.lower() in result_road)
+                matches = sum(1 for w in features['street_words'] if w in display or w in result_road)
                 score += min(15, matches * 7)
         
         # 4. Address type quality (15 points)
@@ -148,28 +1029,82 @@ class UltimateGeocoder:
         # Ensure score is in valid range
         return max(0, min(100, score))
     
+    def _provider_fetch(self, provider, params):
+        """One provider request, results tagged with the provider name"""
+        results = provider.parse(self._fetch(provider.name, provider.endpoint, provider.url, params))
+        for r in results:
+            r['_provider'] = provider.name
+        return results
+    
+    def _provider_call(self, provider, params, row, newer_than):
+        """_provider_fetch on a hedge thread, returning the counters it used"""
+        self._begin_row(row, newer_than)
+        try:
+            results = self._provider_fetch(provider, params)
+        except Exception as e:
+            logging.error(f"{provider.name} error: {e}")
+            results = []
+        return results, self._local.requests, self._local.response_hits, self._local.fetch_errors
+    
+    def _submit(self, provider, params, row, newer_than):
+        """
+        Start a hedge call, counted as one request right away: a call still
+        running when the row finishes is real provider traffic too
+        """
+        self._local.requests = getattr(self._local, 'requests', 0) + 1
+        return self._hedge_pool.submit(self._provider_call, provider, params, row, newer_than)
+    
+    def _absorb(self, future):
+        """Results of a finished hedge call, its counters added to this row"""
+        results, requests_used, response_hits, fetch_errors = future.result()
+        # The call was counted as one request when submitted (cache hits and retries correct it)
+        self._local.requests = getattr(self._local, 'requests', 0) + requests_used - 1
+        self._local.response_hits = getattr(self._local, 'response_hits', 0) + response_hits
+        self._local.fetch_errors = getattr(self._local, 'fetch_errors', 0) + fetch_errors
+        return results
+    
+    def _hedged(self, calls):
+        """
+        Run (provider, params) calls in priority order as a hedged request
+        The next provider is only asked once the previous ones have used up the
+        latency budget or answered nothing; returns the merged results of every
+        call finished by the time the first results arrive. Late calls keep
+        running and still fill the raw response cache.
+        """
+        calls = [(provider, params) for provider, params in calls if params is not None]
+        if not calls:
+            return []
+        if len(calls) == 1 or self._hedge_pool is None:
+            return self._provider_fetch(*calls[0])
+        
+        row = getattr(self._local, 'row', None)
+        newer_than = getattr(self._local, 'newer_than', None)
+        remaining = deque(calls)
+        pending = {self._submit(*remaining.popleft(), row, newer_than)}
+        results = []
+        while pending:
+            done, pending = wait(pending, timeout=self.hedge_after if remaining else None,
+                                 return_when=FIRST_COMPLETED)
+            for future in done:
+                results.extend(self._absorb(future))
+            if results:
+                break
+            if remaining and (not done or not pending):
+                # Over budget or an empty answer - ask the next provider
+                provider, params = remaining.popleft()
+                pending.add(self._submit(provider, params, row, newer_than))
+                self._notify('hedge', provider=provider.name)
+        for future in pending:
+            if future.done():
+                results.extend(self._absorb(future))
+        return results
+    
     def _nominatim_search(self, query, limit=10):
-        """Enhanced Nominatim search with multiple strategies"""
+        """Free-text search across the configured providers (hedged)"""
         results = []
         
-        # Strategy 1: Exact query with enhanced parameters
         try:
-            resp = self.session.get(
-                'https://nominatim.openstreetmap.org/search',
-                params={
-                    'q': query,
-                    'format': 'json',
-                    'addressdetails': 1,
-                    'limit': limit,
-                    'countrycodes': 'bg',
-                    'extratags': 1,  # Get OSM tags
-                    'namedetails': 1,  # Get name variations
-                    'dedupe': 0  # Don't merge similar results
-                },
-                timeout=15
-            )
-            if resp.status_code == 200:
-                results.extend(resp.json())
+            results.extend(self._hedged((p, p.search_params(query, limit)) for p in self.providers))
         except Exception as e:
             logging.error(f"Nominatim search error for '{query}': {e}")
         
@@ -180,223 +1115,369 @@ class UltimateGeocoder:
         results = []
         
         try:
-            # Variation 1: Full structured query
-            params = {
-                'format': 'json',
-                'addressdetails': 1,
-                'limit': 10,
-                'country': 'Bulgaria',
-                'countrycodes': 'bg',
-                'extratags': 1,
-                'namedetails': 1
-            }
-            
-            if city:
-                params['city'] = city
-            if street and house_number:
-                params['street'] = f"{street} {house_number}"
-            elif street:
-                params['street'] = street
-            
-            resp = self.session.get(
-                'https://nominatim.openstreetmap.org/search',
-                params=params,
-                timeout=15
-            )
-            
-            if resp.status_code == 200:
-                results.extend(resp.json())
+            # Variation 1: Full structured query (providers without structured search are skipped)
+            calls = [(p, p.structured_params(street, city, house_number)) for p in self.providers]
+            results.extend(self._hedged(calls))
             
             # Variation 2: If we have house number, try separate field
             if house_number and len(results) < 3:
-                time.sleep(1.0)
-                params2 = params.copy()
-                params2['street'] = street
-                params2.pop('city', None)
-                params2['city'] = city
-                
-                # Try adding postal code search variation
-                resp2 = self.session.get(
-                    'https://nominatim.openstreetmap.org/search',
-                    params=params2,
-                    timeout=15
-                )
-                
-                if resp2.status_code == 200:
-                    results.extend(resp2.json())
+                calls2 = [(p, dict(params, street=street, city=city) if params is not None else None)
+                          for p, params in calls]
+                results.extend(self._hedged(calls2))
                     
         except Exception as e:
             logging.error(f"Nominatim structured error: {e}")
         
         return results
     
-    def _overpass_search(self, name, city):
-        """Search OpenStreetMap for hospital/clinic by name"""
-        try:
-            # Build Overpass query
+    def _settlement_pois(self, city):
+        """
+        All hospital/clinic/doctors POIs of a settlement, one Overpass query per city
+        Kept in memory for the run; the raw response cache persists it across runs
+        """
+        with self._poi_lock:
+            if city in self._poi_index:
+                return self._poi_index[city]
+            city_lock = self._poi_city_locks.setdefault(city, threading.Lock())
+        
+        # Concurrent rows from the same settlement wait for a single fetch
+        with city_lock:
+            if city in self._poi_index:
+                return self._poi_index[city]
+            
             query = f"""
-            [out:json][timeout:25];
+            [out:json][timeout:90];
             area["name"="{city}"]["place"~"city|town"]["admin_level"="8"]->.searchArea;
-            (
-                nwr["name"~"{re.escape(name)}",i]["amenity"~"hospital|clinic|doctors"](area.searchArea);
-                nwr["name"~"МБАЛ|болница",i]["amenity"~"hospital|clinic"](area.searchArea);
-            );
-            out center;
+            nwr["amenity"~"hospital|clinic|doctors"](area.searchArea);
+            out center tags;
             """
+            try:
+                data = self._fetch(
+                    'overpass', 'overpass/interpreter',
+                    self.urls['overpass'],
+                    {'data': query},
+                    method='POST', timeout=120
+                )
+            except Exception as e:
+                logging.warning(f"Overpass settlement fetch error for {city}: {e}")
+                return []
             
-            resp = self.session.post(
-                'https://overpass-api.de/api/interpreter',
-                data={'data': query},
-                timeout=30
-            )
+            if data is None:
+                # Not stored, so a later row may retry the fetch
+                return []
+            elements = data.get('elements', [])
+            names = NameIndex((el['tags']['name'], el) for el in elements
+                              if el.get('tags', {}).get('name'))
+            hospitals = [el for el in elements
+                         if HOSPITAL_NAME_RE.search(el.get('tags', {}).get('name', ''))
+                         and el.get('tags', {}).get('amenity') in ('hospital', 'clinic')]
+            with self._poi_lock:
+                self._poi_names[city] = (names, hospitals)
+                self._poi_index[city] = elements
+            logging.info(f"Overpass POI index: {city} ({len(elements)} POIs)")
+            return elements
+    
+    def prefetch_settlements(self, cities, workers=4):
+        """Warm the POI index for every settlement before rows are geocoded"""
+        cities = sorted({c for c in cities if c})
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            counts = list(pool.map(lambda c: len(self._settlement_pois(c)), cities))
+        return len(cities), sum(counts)
+    
+    def _overpass_search(self, name, city):
+        """Search OpenStreetMap for hospital/clinic by name (matched locally against the settlement POIs)"""
+        try:
+            self._settlement_pois(city)
+            if city not in self._poi_names:
+                return None
+            names, hospitals = self._poi_names[city]
+            
+            # Fuzzy name matches among the healthcare POIs, plus any hospital-named POI
+            elements = {}
+            for similarity, _, el in names.top(name, k=5, min_similarity=POI_NAME_SIMILARITY):
+                if el.get('tags', {}).get('amenity') in ('hospital', 'clinic', 'doctors'):
+                    elements[id(el)] = (similarity, el)
+            for el in hospitals:
+                elements.setdefault(id(el), (0.0, el))
             
-            if resp.status_code == 200:
-                data = resp.json()
-                elements = data.get('elements', [])
+            if elements:
+                # Score by name similarity
+                best = None
+                best_score = 0
                 
-                if elements:
-                    # Score by name similarity
-                    best = None
-                    best_score = 0
+                for similarity, el in elements.values():
+                    tags = el.get('tags', {})
+                    
+                    # Up to 50 for the name, 30 for an actual hospital
+                    score = int(round(50 * similarity))
+                    if tags.get('amenity') == 'hospital':
+                        score += 30
                     
-                    for el in elements:
-                        tags = el.get('tags', {})
-                        el_name = tags.get('name', '')
-                        
-                        # Simple scoring
-                        score = 0
-                        if name.lower() in el_name.lower():
-                            score += 50
-                        if tags.get('amenity') == 'hospital':
-                            score += 30
-                        
-                        if score > best_score:
-                            best_score = score
-                            best = el
+                    if score > best_score:
+                        best_score = score
+                        best = el
+                
+                if best and best_score >= 30:
+                    if 'lat' in best and 'lon' in best:
+                        lat, lon = best['lat'], best['lon']
+                    elif 'center' in best:
+                        lat, lon = best['center']['lat'], best['center']['lon']
+                    else:
+                        return None
                     
-                    if best and best_score >= 30:
-                        if 'lat' in best and 'lon' in best:
-                            lat, lon = best['lat'], best['lon']
-                        elif 'center' in best:
-                            lat, lon = best['center']['lat'], best['center']['lon']
-                        else:
-                            return None
-                        
-                        return {
-                            'lat': lat,
-                            'lon': lon,
-                            'display_name': best.get('tags', {}).get('name', 'Unknown'),
-                            'score': best_score
-                        }
+                    return {
+                        'lat': lat,
+                        'lon': lon,
+                        'display_name': best.get('tags', {}).get('name', 'Unknown'),
+                        'score': best_score
+                    }
         except Exception as e:
             logging.warning(f"Overpass search error for '{name}' in {city}: {e}")
         
         return None
     
-    def geocode(self, address, city, oblast, name=None, street_number_hint=None, street_name_hint=None):
+    def _add_candidates(self, candidates, grid, results, scores, provider, strategy):
+        """Append the acceptable, non-duplicate scored results"""
+        for r, score in zip(results, scores):
+            # Lower threshold but track all candidates
+            if score >= 30:  # Accept more candidates for comparison
+                # Check for duplicates (same coordinates)
+                if grid.add(float(r['lat']), float(r['lon'])):
+                    candidates.append({
+                        'lat': float(r['lat']),
+                        'lng': float(r['lon']),
+                        'display': r['display_name'],
+                        # Secondary backends are credited by name (e.g. 'photon')
+                        'provider': provider if r.get('_provider', 'nominatim') == 'nominatim' else r['_provider'],
+                        'score': int(score),
+                        'osm_type': r.get('osm_type', ''),
+                        'osm_id': r.get('osm_id', ''),
+                        'strategy': strategy
+                    })
+    
+    def _add_poi_candidate(self, candidates, grid, result, strategy):
+        lat, lng = float(result['lat']), float(result['lon'])
+        grid.add(lat, lng)
+        candidates.append({
+            'lat': lat,
+            'lng': lng,
+            'display': result['display_name'],
+            'provider': 'overpass',
+            'score': result['score'] + 20,  # Bonus for exact POI match
+            'strategy': strategy
+        })
+    
+    def cache_key(self, address, city, oblast):
+        """Canonical key, so 'ГР.БУРГАС'/'Бургас' or '№36'/'36' share one entry"""
+        return f"{canonical_text(address)}||{canonical_text(city)}||{canonical_text(oblast)}"
+    
+    def is_fresh(self, entry):
+        """Whether a stored entry can be reused without geocoding again"""
+        if entry is None or entry.get('scoring_version', 1) != SCORING_VERSION:
+            return False
+        ttl = self.negative_ttl if entry.get('failed') else self.positive_ttl
+        return time.time() - entry.get('cached_at', 0) < ttl
+    
+    def _store(self, cache_key, value):
+        cached_at = time.time()
+        if not self.last_requests:
+            # Rebuilt from cached responses only (re-scoring, offline): the data is
+            # as old as before, so the entry keeps its age and still expires on time
+            previous = self.cache.get(cache_key)
+            if previous is not None and previous.get('cached_at'):
+                cached_at = previous['cached_at']
+        self.cache[cache_key] = dict(value, cached_at=cached_at, scoring_version=SCORING_VERSION)
+    
+    def _store_failure(self, cache_key):
+        """Negative entry, so unresolvable rows are not re-queried before NEGATIVE_TTL_DAYS"""
+        self._store(cache_key, {'lat': None, 'lng': None, 'provider': None, 'display': None,
+                                'score': 0, 'failed': True})
+    
+    def cached_result(self, address, city, oblast):
+        """Stored winner for an address, also under the pre-canonical key format"""
+        cached = self.cache.get(self.cache_key(address, city, oblast))
+        if cached is None:
+            cached = self.cache.get(f"{address}||{city}||{oblast}")
+        return cached
+    
+    @property
+    def last_requests(self):
+        """Network requests issued by the last geocode() call on this thread"""
+        return getattr(self._local, 'requests', 0)
+    
+    def _strategy_plan(self, address, city, oblast, name, street_number, street_name):
         """
-        Ultimate geocoding with multi-strategy approach
-        Returns: (lat, lng, provider, display_name, quality_score)
+        Ordered (strategy, call) pairs for one row, best historical strategies first
+        call() returns the raw provider results of that strategy
         """
-        # Cache key
-        cache_key = f"{address}||{city}||{oblast}"
+        # === STRATEGY 1: Free-text search with enhanced variations ===
+        queries = {
+            'free_address': f"{address}, {city}, България",
+            'free_street_number': f"{street_name} {street_number}, {city}, България" if street_number and street_name else None,
+            'free_address_oblast': f"{address}, {city}, {oblast}, България",
+            'free_number_street': f"{street_number} {street_name}, {city}" if street_number and street_name else None,
+            # Try without country to get more OSM results
+            'free_address_oblast_nocountry': f"{address}, {city}, {oblast}" if oblast else None,
+        }
+        strategies = [strategy for strategy, query in queries.items() if query]
         
-        if cache_key in self.cache:
-            cached = self.cache[cache_key]
-            return (cached['lat'], cached['lng'], cached['provider'], 
-                   cached['display'], cached.get('score', 50))
+        # === STRATEGY 2: Structured search ===
+        if street_name:
+            strategies.append('structured')
         
-        # Extract components - use hints if provided
-        street_number = street_number_hint if street_number_hint else self._extract_street_number(address)
-        street_name = street_name_hint if street_name_hint else self._extract_street_name(address)
+        # === STRATEGY 3: Overpass by hospital name ===
+        if name:
+            strategies.append('overpass')
         
-        logging.info(f"Geocoding: {address} | {city} | Number={street_number}")
+        plan = []
+        # === STRATEGY 0: Local gazetteer - free, so always first ===
+        if self.gazetteer is not None and (street_name or name):
+            plan.append(('local', lambda: self.gazetteer.search(city, street_name, street_number, name)))
         
-        candidates = []
+        issued = set()
+        for strategy in self.planner.order(strategies):
+            if strategy == 'overpass':
+                plan.append((strategy, lambda: self._overpass_search(name, city)))
+            elif strategy == 'structured':
+                plan.append((strategy, lambda: self._nominatim_structured(street_name, city, street_number)))
+            else:
+                # Skip variants that collapse to a query already sent
+                query = _collapse_query(queries[strategy])
+                if query in issued:
+                    continue
+                issued.add(query)
+                plan.append((strategy, lambda q=query: self._nominatim_search(q, limit=15)))
+        return plan
+    
+    def _scored(self, call, address, city, street_number, municipality=None):
+        """fetch() for a plan step; network calls happen lazily, only for steps that actually run"""
+        def fetch():
+            results = call()
+            if not isinstance(results, list):
+                return results, None
+            return results, [self._score_result(r, address, city, street_number, municipality)
+                             for r in results]
+        return fetch
+    
+    def _escalation_plan(self, address, city, name, street_number, street_name):
+        """
+        Extra (strategy, call) pairs for rows the regular sweep left weak, cheapest first:
+        more query variants, structured search without the house number, then the
+        settlement-wide POI lookup that the regular sweep only runs on a thin result
+        """
+        short_name = ' '.join(t for t in NAME_TOKEN_RE.findall(name or '') if t.lower() not in LEGAL_FORMS)
+        queries = {
+            'free_street_city': f"{street_name}, {city}, България" if street_name else None,
+            'free_name_city': f"{short_name}, {city}, България" if short_name else None,
+            'free_address_nocountry': f"{address}, {city}",
+        }
+        plan = []
+        issued = set()
+        for strategy, query in queries.items():
+            if not query or _collapse_query(query) in issued:
+                continue
+            issued.add(_collapse_query(query))
+            plan.append((strategy, lambda q=_collapse_query(query): self._nominatim_search(q, limit=15)))
+        if street_name and street_number:
+            plan.append(('structured_street', lambda: self._nominatim_structured(street_name, city)))
+        if name:
+            plan.append(('settlement_poi', lambda: self._overpass_search(name, city)))
+        return plan
+    
+    def improve(self, address, city, oblast, name, street_number, street_name, municipality,
+                current, target, budget):
+        """
+        Escalate one weak row until a candidate reaches `target` or the budget runs out
+        current: the row's geocode() tuple from the last run, kept unless beaten
+        Returns (geocode() tuple, possibly unchanged; whether any strategy ran)
+        """
+        cache_key = self.cache_key(address, city, oblast)
+        self._begin_row(cache_key)
+        address, city = clean_address(address), clean_city(city)
         
-        # === STRATEGY 1: Free-text search with enhanced variations ===
-        queries = [
-            f"{address}, {city}, България",
-            f"{street_name} {street_number}, {city}, България" if street_number and street_name else None,
-            f"{address}, {city}, {oblast}, България",
-            f"{street_number} {street_name}, {city}" if street_number and street_name else None,
-            # Try without country to get more OSM results
-            f"{address}, {city}, {oblast}" if oblast else None,
-        ]
+        parts = split_addresses(address, city)
+        steps = []
+        for part_address, part_city in parts:
+            if len(parts) > 1:
+                street_number = self._extract_street_number(part_address)
+                street_name = self._extract_street_name(part_address)
+            for strategy, call in self._escalation_plan(part_address, part_city, name,
+                                                        street_number, street_name):
+                steps.append((strategy, self._scored(call, part_address, part_city, street_number,
+                                                     municipality)))
         
-        for query in queries:
-            if not query:
-                continue
-            
-            results = self._nominatim_search(query, limit=15)
-            
-            # Filter and score each result
-            for r in results:
-                score = self._score_result(r, address, city, street_number)
-                
-                # Lower threshold but track all candidates
-                if score >= 30:  # Accept more candidates for comparison
-                    # Check for duplicates (same coordinates)
-                    is_duplicate = any(
-                        abs(float(r['lat']) - c['lat']) < 0.0001 and 
-                        abs(float(r['lon']) - c['lng']) < 0.0001
-                        for c in candidates
-                    )
-                    
-                    if not is_duplicate:
-                        candidates.append({
-                            'lat': float(r['lat']),
-                            'lng': float(r['lon']),
-                            'display': r['display_name'],
-                            'provider': 'nominatim_free',
-                            'score': score,
-                            'osm_type': r.get('osm_type', ''),
-                            'osm_id': r.get('osm_id', '')
-                        })
-            
-            time.sleep(1.0)  # Rate limiting
+        candidates = []
+        grid = CandidateGrid()
+        lat, lng, provider, display, score = current
+        if lat is not None:
+            grid.add(lat, lng)
+            candidates.append({'lat': lat, 'lng': lng, 'display': display, 'score': score, 'strategy': None,
+                               'provider': (provider or 'unknown').removesuffix('_lowconf')})
         
-        # === STRATEGY 2: Structured search ===
-        if street_name:
-            results = self._nominatim_structured(street_name, city, street_number)
-            for r in results:
-                score = self._score_result(r, address, city, street_number)
-                
-                if score >= 30:
-                    # Check for duplicates
-                    is_duplicate = any(
-                        abs(float(r['lat']) - c['lat']) < 0.0001 and 
-                        abs(float(r['lon']) - c['lng']) < 0.0001
-                        for c in candidates
-                    )
-                    
-                    if not is_duplicate:
-                        candidates.append({
-                            'lat': float(r['lat']),
-                            'lng': float(r['lon']),
-                            'display': r['display_name'],
-                            'provider': 'nominatim_structured',
-                            'score': score,
-                            'osm_type': r.get('osm_type', ''),
-                            'osm_id': r.get('osm_id', '')
-                        })
-            
-            time.sleep(1.0)
+        attempted = []
+        for strategy, fetch in steps:
+            if max((c['score'] for c in candidates), default=0) >= target or not budget.allow():
+                break
+            attempted.append(strategy)
+            before = self.last_requests
+            started = time.perf_counter()
+            results, scores = fetch()
+            budget.spend(self.last_requests - before)
+            if scores is None:
+                self._notify('strategy', strategy=strategy, seconds=time.perf_counter() - started,
+                             results=int(bool(results)),
+                             best_score=results['score'] + 20 if results else None)
+                if results:
+                    self._add_poi_candidate(candidates, grid, results, strategy)
+            else:
+                self._notify('strategy', strategy=strategy, seconds=time.perf_counter() - started,
+                             results=len(results), best_score=int(max(scores)) if scores else None)
+                self._add_candidates(candidates, grid, results, scores,
+                                     STRATEGY_PROVIDERS.get(strategy, 'nominatim_free'), strategy)
         
-        # === STRATEGY 3: Overpass by hospital name ===
-        if name and len(candidates) < 2:
-            overpass_result = self._overpass_search(name, city)
-            if overpass_result:
-                candidates.append({
-                    'lat': float(overpass_result['lat']),
-                    'lng': float(overpass_result['lon']),
-                    'display': overpass_result['display_name'],
-                    'provider': 'overpass',
-                    'score': overpass_result['score'] + 20  # Bonus for exact POI match
-                })
+        if not attempted:
+            return current, False
+        return self._finish(cache_key, candidates, attempted, address, city,
+                            requests_used=self.last_requests, fallback=None), True
+    
+    def _collect_candidates(self, steps):
+        """
+        Run (strategy, fetch) steps in order, stopping as soon as one is good enough
+        fetch() returns (results, scores); returns (candidates, attempted strategies)
+        """
+        candidates = []
+        grid = CandidateGrid()
+        attempted = []
+        for strategy, fetch in steps:
+            if self.planner.should_stop(candidates):
+                break
             
-            time.sleep(1.0)
-        
+            if strategy == 'overpass':
+                # Only worth a POI lookup when address search found little
+                if len(candidates) >= 2:
+                    continue
+                attempted.append(strategy)
+                started = time.perf_counter()
+                overpass_result, _ = fetch()
+                self._notify('strategy', strategy=strategy, seconds=time.perf_counter() - started,
+                             results=int(bool(overpass_result)),
+                             best_score=overpass_result['score'] + 20 if overpass_result else None)
+                if overpass_result:
+                    self._add_poi_candidate(candidates, grid, overpass_result, strategy)
+            else:
+                attempted.append(strategy)
+                started = time.perf_counter()
+                results, scores = fetch()
+                self._notify('strategy', strategy=strategy, seconds=time.perf_counter() - started,
+                             results=len(results) if isinstance(results, list) else 0,
+                             best_score=int(max(scores)) if scores is not None and len(scores) else None)
+                provider = STRATEGY_PROVIDERS.get(strategy, 'nominatim_free')
+                self._add_candidates(candidates, grid, results, scores, provider, strategy)
+        return candidates, attempted
+    
+    def _finish(self, cache_key, candidates, attempted, address, city, stored=None, response_hits=0,
+                requests_used=0, fallback=None):
+        """Select the best candidate, cache it and build the geocode() return tuple"""
         # === SELECT BEST CANDIDATE with enhanced filtering (SHOW ALL RESULTS) ===
         if candidates:
             # Sort by score (highest first)
@@ -419,24 +1500,961 @@ class UltimateGeocoder:
                 provider = f"{provider}_lowconf"
 
             # Cache result (store exact returned score)
-            self.cache[cache_key] = {
+            self._store(cache_key, {
                 'lat': best['lat'],
                 'lng': best['lng'],
                 'provider': provider,
                 'display': best.get('display'),
                 'score': best.get('score', 0)
-            }
-            self._save_cache()
+            })
 
-            logging.info(f"✓ Selected ({chosen_reason}): {str(best.get('display'))[:80]} (score={best.get('score')}, provider={provider})")
+            if not self.offline:
+                self.planner.record(attempted, best.get('strategy'))
+            self._notify_row(chosen_reason, best.get('strategy'), best.get('score', 0), requests_used)
+            logging.info(f"✓ Selected ({chosen_reason}): {str(best.get('display'))[:80]} "
+                         f"(score={best.get('score')}, provider={provider}, requests={requests_used})")
             return (best['lat'], best['lng'], provider, best.get('display'), best.get('score', 0))
         
+        # Nothing recorded for this row yet - keep the stored winner when re-scoring
+        if stored is not None and response_hits == 0:
+            self._notify_row('stored', None, stored.get('score', 50), requests_used)
+            logging.info(f"No cached responses, keeping stored result: {address}, {city}")
+            return (stored['lat'], stored['lng'], stored['provider'],
+                   stored['display'], stored.get('score', 50))
+        
         # No acceptable result found
-        logging.warning(f"✗ Failed to geocode: {address}, {city}")
+        if getattr(self._local, 'fetch_errors', 0):
+            # Provider outage, not a strategy miss - keep it out of the planner stats
+            # and out of the negative cache; a stale winner beats no answer
+            self._notify_row('provider_error', None, 0, requests_used)
+            logging.warning(f"✗ Failed to geocode (provider errors): {address}, {city} "
+                            f"(requests={requests_used})")
+            if fallback is not None:
+                return (fallback['lat'], fallback['lng'], fallback['provider'],
+                        fallback['display'], fallback.get('score', 50))
+            return (None, None, None, None, 0)
+        if not self.offline:
+            self.planner.record(attempted, None)
+            self._store_failure(cache_key)
+        self._notify_row('failed', None, 0, requests_used)
+        logging.warning(f"✗ Failed to geocode: {address}, {city} (requests={requests_used})")
         return (None, None, None, None, 0)
+    
+    def geocode(self, address, city, oblast, name=None, street_number_hint=None, street_name_hint=None,
+                refresh=False, municipality=None):
+        """
+        Ultimate geocoding with multi-strategy approach
+        refresh=True ignores the stored winner and re-scores the provider responses
+        municipality (Община) tells same-named villages apart in the boundary check
+        Returns: (lat, lng, provider, display_name, quality_score)
+        """
+        cache_key = self.cache_key(address, city, oblast)
+        self._begin_row(cache_key)
+        
+        stored = self.cached_result(address, city, oblast)
+        # Offline, a stale entry is still the best answer available
+        if stored is not None and not refresh and (self.offline or self.is_fresh(stored)):
+            self._notify_row('negative_cached' if stored.get('failed') else 'cached',
+                             None, stored.get('score', 50), 0)
+            return (stored['lat'], stored['lng'], stored['provider'], 
+                   stored['display'], stored.get('score', 50))
+        # Stale winner: re-geocoded, but still the answer if the providers are down
+        fallback = stored if stored is not None and not stored.get('failed') else None
+        if stored is not None and not refresh and stored.get('scoring_version', 1) == SCORING_VERSION:
+            # Expired, so the raw responses behind it are as old - fetch them again
+            self._local.newer_than = stored.get('cached_at', 0)
+        
+        address, city = clean_address(address), clean_city(city)
+        
+        # Several addresses in one cell - geocode each, keep the best
+        parts = split_addresses(address, city)
+        if len(parts) > 1:
+            return self._geocode_parts(cache_key, parts, oblast, name, refresh, stored, municipality)
+        if parts:
+            # A single address with a ';'-list of settlements goes with the first one
+            address, city = parts[0]
+        
+        # Extract components - use hints if provided
+        street_number = street_number_hint if street_number_hint else self._extract_street_number(address)
+        street_name = street_name_hint if street_name_hint else self._extract_street_name(address)
+        
+        logging.info(f"Geocoding: {address} | {city} | Number={street_number}")
+        
+        plan = self._strategy_plan(address, city, oblast, name, street_number, street_name)
+        candidates, attempted = self._collect_candidates(
+            (strategy, self._scored(call, address, city, street_number, municipality))
+            for strategy, call in plan)
+        return self._finish(cache_key, candidates, attempted, address, city,
+                            stored if refresh else None, self._local.response_hits, self.last_requests,
+                            fallback)
+    
+    def _geocode_parts(self, cache_key, parts, oblast, name, refresh=False, stored=None, municipality=None):
+        """Best geocode() result over the addresses of a multi-address cell"""
+        results = []
+        requests_used = 0
+        response_hits = 0
+        fetch_errors = 0
+        for address, city in parts:
+            results.append(self.geocode(address, city, oblast, name, refresh=refresh, municipality=municipality))
+            requests_used += self.last_requests
+            response_hits += self._local.response_hits
+            fetch_errors += self._local.fetch_errors
+        self._local.requests = requests_used
+        self._local.response_hits = response_hits
+        self._local.fetch_errors = fetch_errors
+        
+        # Re-scoring without any recorded response - keep the stored winner
+        if refresh and stored is not None and response_hits == 0:
+            return (stored['lat'], stored['lng'], stored['provider'],
+                   stored['display'], stored.get('score', 50))
+        
+        best = max(results, key=lambda r: r[4])
+        if best[0] is None and fetch_errors and stored is not None and not stored.get('failed'):
+            # Provider outage, as in geocode(): a stale winner beats no answer
+            logging.warning(f"Multi-address cell ({len(parts)} parts) hit provider errors, "
+                            f"keeping the stored result")
+            return (stored['lat'], stored['lng'], stored['provider'],
+                   stored['display'], stored.get('score', 50))
+        if best[0] is not None:
+            lat, lng, provider, display, score = best
+            self._store(cache_key, {'lat': lat, 'lng': lng, 'provider': provider,
+                                    'display': display, 'score': score})
+        elif not self.offline and not fetch_errors:
+            self._store_failure(cache_key)
+        logging.info(f"Multi-address cell ({len(parts)} parts): best score {best[4]}, requests={requests_used}")
+        return best
+    
+    def rescore_rows(self, rows):
+        """
+        Offline re-scoring of many rows at once from the raw response cache
+        rows: iterable of (address, city, oblast, name, street_number, street_name, municipality)
+        All cached results are scored in one vectorized pass, then each row's
+        strategy sweep is replayed exactly as geocode() would run it
+        Returns a list of geocode() tuples
+        """
+        # Collect: every cached response of every strategy, per row
+        collected = []
+        flat = []
+        features = {}
+        areas = {}
+        for row_id, (raw_address, raw_city, oblast, name, street_number, street_name,
+                     municipality) in enumerate(rows):
+            stored = self.cached_result(raw_address, raw_city, oblast)
+            parts = split_addresses(clean_address(raw_address), clean_city(raw_city))
+            if len(parts) > 1:
+                # Multi-address cells go through the per-row path (still offline),
+                # with the same raw values as the main run so they hit the same key
+                collected.append((self.geocode(raw_address, raw_city, oblast, name, refresh=True,
+                                               municipality=municipality), None))
+                continue
+            cache_key = self.cache_key(raw_address, raw_city, oblast)
+            # As in geocode(): a single address goes with the first settlement of a list
+            address, city = parts[0] if parts else (clean_address(raw_address), clean_city(raw_city))
+            street_number = street_number or self._extract_street_number(address)
+            street_name = street_name or self._extract_street_name(address)
+            features[row_id] = _score_features(address, city, street_number)
+            areas[row_id] = (city, municipality)
+            self._local.response_hits = 0
+            steps = []
+            for strategy, call in self._strategy_plan(address, city, oblast, name, street_number, street_name):
+                results = call()
+                if isinstance(results, list):
+                    start = len(flat)
+                    flat.extend((row_id, r) for r in results)
+                    steps.append((strategy, results, (start, len(flat))))
+                else:
+                    steps.append((strategy, results, None))
+            collected.append((None, (cache_key, address, city, steps,
+                                     stored, self._local.response_hits)))
+        
+        # Score: one pass over all rows' candidates
+        geo_match = ([self._geo_match(r, *areas[row_id]) for row_id, r in flat]
+                     if self.boundaries is not None else None)
+        scores = score_results_batch(flat, features, geo_match)
+        
+        # Select: replay the strategy order with the precomputed scores
+        output = []
+        for done, replay in collected:
+            if done is not None:
+                output.append(done)
+                continue
+            cache_key, address, city, steps, stored, response_hits = replay
+            self._begin_row(cache_key)
+            candidates, attempted = self._collect_candidates(
+                (strategy, lambda results=results, span=span:
+                    (results, scores[span[0]:span[1]] if span else None))
+                for strategy, results, span in steps)
+            output.append(self._finish(cache_key, candidates, attempted, address, city,
+                                       stored=stored, response_hits=response_hits))
+        return output
+
+
+def extract_street_number(address):
+    """Extract street number from address"""
+    match = STREET_NUMBER_RE.search(address)
+    return match.group(1) if match else None
+
+
+def extract_street_name(address):
+    """Extract clean street name without number"""
+    # Remove prefixes
+    addr = address.replace('ул.', '').replace('бул.', '').replace('жк', '').strip()
+    # Remove number
+    return TRAILING_NUMBER_RE.sub('', addr).strip()
+
+
+def clean_registry(df):
+    """
+    Cleaned copy of the raw registry, the rules behind hospitals_official_cleaned.csv
+    (the shipped file also has hand edits; --check-clean lists where the two differ)
+    """
+    df = df.copy()
+    df['Населено място'] = df['Населено място'].fillna('').astype(str).map(clean_city)
+    df['Адрес'] = df['Адрес'].fillna('').astype(str).map(clean_address)
+    return df
+
+
+def registry_differences(raw, cleaned):
+    """Cells where clean_registry(raw) differs from `cleaned`: (row, column, ours, theirs) rows"""
+    ours = clean_registry(raw)
+    differences = []
+    for column in ('Населено място', 'Адрес'):
+        theirs = cleaned[column].fillna('').astype(str)
+        for i in ours.index[ours[column] != theirs]:
+            differences.append((i, column, ours.at[i, column], theirs[i]))
+    return pd.DataFrame(differences, columns=['row', 'column', 'clean_registry', 'cleaned_csv'])
+
+
+@functools.lru_cache(maxsize=8192)
+def _score_features(address, city, street_number):
+    """Per-row inputs of the scoring rules, computed once per row"""
+    street_name = extract_street_name(address)
+    long_name = len(street_name) > 3
+    return {
+        'city_lower': city.lower(),
+        'street_number': street_number,
+        'number_digits': NON_DIGIT_RE.sub('', street_number) if street_number else '',
+        # Street rules only apply to names longer than 3 characters
+        'street_lower': street_name.lower() if long_name else '',
+        'street_words': tuple(w.lower() for w in street_name.split() if len(w) > 3) if long_name else (),
+    }
+
+
+def _contains(needles, haystacks):
+    """Element-wise `needle in haystack` over two equal-length arrays"""
+    return np.fromiter((n in h for n, h in zip(needles, haystacks)), dtype=bool, count=len(needles))
+
+
+def _decimals(values):
+    """Digits after the last '.' of each coordinate string (0 without a dot)"""
+    return np.fromiter((len(v.split('.')[-1]) if '.' in v else 0 for v in values),
+                       dtype=float, count=len(values))
+
+
+def score_results_batch(results, features, geo_match=None):
+    """
+    Vectorized _score_result for candidates of many rows at once
+    results: list of (row_id, nominatim_result); features: {row_id: _score_features(...)}
+    geo_match: optional per-candidate boundary verdicts (True/False/None)
+    Returns an int array of scores in the same order, identical to _score_result
+    """
+    n = len(results)
+    if n == 0:
+        return np.zeros(0, dtype=int)
+    
+    # Columnar candidate fields
+    rows = [row_id for row_id, _ in results]
+    display = np.array([r.get('display_name', '').lower() for _, r in results], dtype=object)
+    addr = [r.get('address', {}) for _, r in results]
+    result_city = np.array([(a.get('city') or a.get('town') or a.get('village') or '').lower()
+                            for a in addr], dtype=object)
+    house_number = np.array([a.get('house_number', '') for a in addr], dtype=object)
+    road = np.array([(a.get('road') or a.get('street') or '').lower() for a in addr], dtype=object)
+    lat = [str(r.get('lat', '')) for _, r in results]
+    lon = [str(r.get('lon', '')) for _, r in results]
+    osm_type = np.array([r.get('osm_type', '') for _, r in results], dtype=object)
+    result_class = np.array([r.get('class', '') for _, r in results], dtype=object)
+    result_type = np.array([r.get('type', '') for _, r in results], dtype=object)
+    
+    # Per-row features broadcast to candidates
+    feats = pd.DataFrame([features[row_id] for row_id in rows])
+    city_lower = feats['city_lower'].to_numpy(dtype=object)
+    street_number = feats['street_number'].fillna('').to_numpy(dtype=object)
+    number_digits = feats['number_digits'].to_numpy(dtype=object)
+    street_lower = feats['street_lower'].to_numpy(dtype=object)
+    street_words = feats['street_words'].to_numpy(dtype=object)
+    
+    # 0. Boundary verdicts
+    inside = np.array([g is True for g in geo_match], dtype=bool) if geo_match is not None else np.zeros(n, bool)
+    outside = np.array([g is False for g in geo_match], dtype=bool) if geo_match is not None else np.zeros(n, bool)
+    
+    # 1. City
+    city_points = np.where(inside | (result_city == city_lower), 30,
+                           np.where(_contains(city_lower, display), 20, -30))
+    
+    # 2. Street number
+    has_number = street_number != ''
+    has_result_number = house_number != ''
+    number_in_display = has_number & _contains(street_number, display)
+    result_digits = np.array([NON_DIGIT_RE.sub('', h) for h in house_number], dtype=object)
+    number_points = np.select(
+        [has_number & has_result_number & (street_number == house_number),
+         has_number & has_result_number & (number_digits == result_digits),
+         has_number & has_result_number & number_in_display,
+         has_number & has_result_number,
+         number_in_display,
+         has_number],
+        [40, 35, 25, 0, 20, -10], default=0)
+    
+    # 3. Street name
+    has_street = street_lower != ''
+    road_match = _contains(street_lower, road) | _contains(road, street_lower)
+    word_matches = np.fromiter(
+        (sum(1 for w in words if w in d or w in r) for words, d, r in zip(street_words, display, road)),
+        dtype=int, count=n)
+    street_points = np.select(
+        [has_street & road_match,
+         has_street & _contains(street_lower, display),
+         has_street],
+        [25, 15, np.minimum(15, word_matches * 7)], default=0)
+    
+    # 4. Address type
+    type_points = np.where(has_result_number, 8, 0) + np.where(road != '', 7, 0)
+    
+    # 5. Coordinate precision
+    avg_precision = (_decimals(lat) + _decimals(lon)) / 2
+    precision_points = np.select([avg_precision >= 7, avg_precision >= 5], [10, 5], default=0)
+    
+    # 6. OSM type
+    osm_points = np.select([osm_type == 'node', osm_type == 'way'], [5, 3], default=0)
+    
+    # 7. Class/type
+    medical = np.isin(result_type.astype(str), ['hospital', 'clinic', 'doctors'])
+    class_points = np.select(
+        [(result_class == 'building') | (result_type == 'house'),
+         (result_class == 'amenity') & medical,
+         result_class == 'place'],
+        [5, 5, -20], default=0)
+    
+    score = (city_points + number_points + street_points + type_points
+             + precision_points + osm_points + class_points)
+    return np.where(outside, 0, np.clip(score, 0, 100)).astype(int)
+
 
+class CandidateGrid:
+    """
+    Spatial hash for candidate deduplication
+    Points closer than `cell` degrees on both axes are duplicates; only the
+    3x3 neighbouring cells are checked, so each lookup is O(1)
+    """
 
-def main():
+    def __init__(self, cell=0.0001):
+        self.cell = cell
+        self.cells = {}
+
+    def add(self, lat, lng):
+        """Register a point, returns False if it duplicates an existing one"""
+        cy, cx = int(lat // self.cell), int(lng // self.cell)
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                for plat, plng in self.cells.get((cy + dy, cx + dx), ()):
+                    if abs(lat - plat) < self.cell and abs(lng - plng) < self.cell:
+                        return False
+        self.cells.setdefault((cy, cx), []).append((lat, lng))
+        return True
+
+
+def _describe_query(params):
+    """Short human-readable form of provider request params, for traces"""
+    if 'q' in params:
+        return params['q']
+    if 'data' in params:
+        return ' '.join(str(params['data']).split())
+    return ', '.join(f"{k}={params[k]}" for k in ('street', 'city') if k in params)
+
+
+def _payload_size(payload):
+    """Number of results in a Nominatim list or Overpass element payload"""
+    if isinstance(payload, dict):
+        return len(payload.get('elements', []))
+    return len(payload or [])
+
+
+def _collapse_query(query):
+    """Normalize whitespace and drop repeated parts, e.g. when oblast equals city"""
+    parts = []
+    for part in query.split(','):
+        part = ' '.join(part.split())
+        if part and (not parts or part.lower() != parts[-1].lower()):
+            parts.append(part)
+    return ', '.join(parts)
+
+
+# Streaming outputs
+OUTPUT_FILE = 'hospitals_ultimate_coords.csv'
+CHECKPOINT_FILE = 'hospitals_ultimate_coords.checkpoint.json'
+RESULT_COLUMNS = ['lat', 'lng', 'provider', 'display_name', 'quality_score']
+# Copy of the last output that --incremental diffs the registry against
+PREVIOUS_FILE = 'hospitals_ultimate_coords.previous.csv'
+# Registry columns that decide whether a row has to be geocoded again
+HASH_COLUMNS = ['Наименование', 'Населено място', 'Адрес', 'Област']
+# Columnar copy of the output (--parquet); pyarrow is optional
+PARQUET_FILE = 'hospitals_ultimate_coords.parquet'
+# Low-cardinality columns stored dictionary-encoded (pandas: category)
+CATEGORY_COLUMNS = ['Област', 'Община', 'Населено място', 'provider']
+# Quality-tier exports: file -> (label, row filter on quality_score)
+TIER_FILES = {
+    'hospitals_excellent.csv': ('Excellent quality', lambda score: score >= 80),
+    'hospitals_needs_manual.csv': ('Needs manual review', lambda score: score < 40),
+}
+
+
+class ResultWriter:
+    """
+    Streams geocoded rows to the output CSV and the quality-tier files in one pass
+    A checkpoint after every row records the byte size of each file, so a
+    resumed run can cut off a partially written tail and continue from the
+    next row
+    """
+
+    def __init__(self, source, output=OUTPUT_FILE, checkpoint=CHECKPOINT_FILE, tiers=TIER_FILES):
+        self.source = source
+        self.output = output
+        self.checkpoint = checkpoint
+        self.tiers = tiers
+        self.next_row = 0
+        self.columns = None
+        self.stats = {'excellent': 0, 'good': 0, 'fair': 0, 'failed': 0}
+        self.counts = {}
+        self.requests = 0
+        self.offsets = {}
+        self.handles = {}
+        self.writers = {}
+
+    def resume(self):
+        """Restore state from the checkpoint, returns False if there is none"""
+        if not os.path.exists(self.checkpoint):
+            return False
+        with open(self.checkpoint, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        if state['source'] != self.source:
+            raise ValueError(f"Checkpoint belongs to {state['source']}, not {self.source}")
+        
+        self.next_row = state['next_row']
+        self.columns = state['columns']
+        self.stats = state['stats']
+        self.counts = state['counts']
+        self.requests = state['requests']
+        # Drop anything written after the last checkpoint
+        for path, size in state['offsets'].items():
+            with open(path, 'r+b') as f:
+                f.truncate(size)
+            self._open(path, append=True)
+        return True
+
+    def _open(self, path, append=False):
+        handle = open(path, 'a' if append else 'w', encoding='utf-8', newline='')
+        self.handles[path] = handle
+        self.writers[path] = csv.writer(handle, lineterminator='\n')
+        if not append:
+            self.writers[path].writerow(self.columns)
+
+    def write(self, row, result, requests_used=0):
+        """Append one geocoded registry row (a Series) to every matching file"""
+        lat, lng, provider, display, score = result
+        if self.columns is None:
+            self.columns = list(row.index)
+        
+        values = row.to_dict()
+        values.update(lat=lat, lng=lng, provider=provider, display_name=display, quality_score=score)
+        record = ['' if v is None or (isinstance(v, float) and v != v) else v
+                  for v in (values.get(c) for c in self.columns)]
+        
+        targets = [self.output] + [path for path, (_, keep) in self.tiers.items() if keep(score)]
+        for path in targets:
+            if path not in self.handles:
+                self._open(path)
+            self.writers[path].writerow(record)
+            self.counts[path] = self.counts.get(path, 0) + 1
+        
+        self.stats[_quality_tier(score)] += 1
+        self.requests += requests_used
+        self.next_row += 1
+        self._save_checkpoint()
+
+    def _save_checkpoint(self):
+        for handle in self.handles.values():
+            handle.flush()
+        state = {
+            'source': self.source,
+            'next_row': self.next_row,
+            'columns': self.columns,
+            'stats': self.stats,
+            'counts': self.counts,
+            'requests': self.requests,
+            'offsets': {path: os.path.getsize(path) for path in self.handles},
+        }
+        tmp = f"{self.checkpoint}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp, self.checkpoint)
+
+    def close(self):
+        """Finish the run; the checkpoint is no longer needed"""
+        for handle in self.handles.values():
+            handle.close()
+        if os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+
+
+def _quality_tiers(scores):
+    """Vectorized _quality_tier"""
+    return np.select([scores >= 80, scores >= 60, scores >= 40], ['excellent', 'good', 'fair'], default='failed')
+
+
+def _arrow_schema(columns):
+    """Typed output schema: float coordinates, int16 score, dictionary-encoded categories"""
+    types = {'lat': pa.float64(), 'lng': pa.float64(), 'quality_score': pa.int16()}
+    category = pa.dictionary(pa.int32(), pa.string())
+    fields = [pa.field(c, types.get(c, category if c in CATEGORY_COLUMNS else pa.string())) for c in columns]
+    return pa.schema(fields + [pa.field('quality_tier', category)])
+
+
+def _arrow_table(chunk, schema):
+    """Arrow table of an output chunk read as strings ('' = missing)"""
+    scores = pd.to_numeric(chunk['quality_score'], errors='coerce').fillna(0)
+    arrays = []
+    for field in schema:
+        if field.name == 'quality_tier':
+            arrays.append(pa.array(_quality_tiers(scores.to_numpy()), type=pa.string()).dictionary_encode())
+        elif field.name == 'quality_score':
+            arrays.append(pa.array(scores.astype('int16').to_numpy(), type=pa.int16()))
+        elif pa.types.is_floating(field.type):
+            arrays.append(pa.array(pd.to_numeric(chunk[field.name], errors='coerce').to_numpy(),
+                                   type=field.type, from_pandas=True))
+        else:
+            values = pa.array(chunk[field.name].where(chunk[field.name] != '', None).to_numpy(dtype=object),
+                              type=pa.string(), from_pandas=True)
+            arrays.append(values.dictionary_encode() if pa.types.is_dictionary(field.type) else values)
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def write_parquet(source=OUTPUT_FILE, path=PARQUET_FILE, chunk_size=50000):
+    """
+    Columnar copy of the output CSV, one row group per chunk, with a quality_tier
+    column, so every tier is a filter on one file instead of another CSV
+    Returns the number of rows written
+    """
+    if pq is None:
+        raise RuntimeError('Parquet output needs pyarrow (pip install pyarrow)')
+    tmp = f"{path}.tmp"
+    writer = None
+    rows = 0
+    try:
+        for chunk in pd.read_csv(source, encoding='utf-8', dtype=str, keep_default_na=False,
+                                 chunksize=chunk_size):
+            if writer is None:
+                schema = _arrow_schema(list(chunk.columns))
+                writer = pq.ParquetWriter(tmp, schema, compression='zstd')
+            writer.write_table(_arrow_table(chunk, schema))
+            rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is not None:
+        os.replace(tmp, path)
+    return rows
+
+
+def load_results(path=PARQUET_FILE, oblast=None, min_quality=None, columns=None):
+    """
+    Geocoded rows as a DataFrame, filtered while reading
+    Parquet: the filters are pushed down to pyarrow, so row groups that cannot
+    match are skipped and only `columns` are decoded. CSV: read in chunks and
+    filtered chunk by chunk. Either way, CATEGORY_COLUMNS come back as category
+    """
+    if path.endswith('.parquet'):
+        if pq is None:
+            raise RuntimeError('Reading Parquet needs pyarrow (pip install pyarrow)')
+        filters = []
+        if oblast:
+            filters.append(('Област', '=', oblast))
+        if min_quality is not None:
+            filters.append(('quality_score', '>=', min_quality))
+        return pq.read_table(path, columns=columns, filters=filters or None).to_pandas()
+    
+    wanted = None
+    if columns is not None:
+        wanted = set(columns) | ({'Област'} if oblast else set()) | ({'quality_score'} if min_quality is not None else set())
+    frames = []
+    for chunk in pd.read_csv(path, encoding='utf-8', chunksize=50000,
+                             usecols=(lambda c: c in wanted) if wanted is not None else None):
+        if oblast:
+            chunk = chunk[chunk['Област'] == oblast]
+        if min_quality is not None:
+            chunk = chunk[chunk['quality_score'] >= min_quality]
+        frames.append(chunk)
+    frame = pd.concat(frames, ignore_index=True)
+    if columns is not None:
+        frame = frame[list(columns)]
+    for column in CATEGORY_COLUMNS:
+        if column in frame.columns:
+            frame[column] = frame[column].astype('category')
+    return frame
+
+
+def row_hashes(frame):
+    """Content hash of the geocoding-relevant columns of every row"""
+    values = frame.reindex(columns=HASH_COLUMNS).fillna('').astype(str)
+    return [
+        hashlib.sha1('\x1f'.join(v.strip() for v in row).encode('utf-8')).hexdigest()
+        for row in values.itertuples(index=False)
+    ]
+
+
+def load_previous_results(path, chunk_size=5000):
+    """Map row hash -> geocode() tuple from a previous output file"""
+    previous = {}
+    for chunk in pd.read_csv(path, encoding='utf-8', chunksize=chunk_size,
+                             usecols=lambda c: c in HASH_COLUMNS or c in RESULT_COLUMNS):
+        results = chunk.reindex(columns=RESULT_COLUMNS).astype(object)
+        results = results.where(results.notna(), None)
+        for key, (lat, lng, provider, display, score) in zip(row_hashes(chunk),
+                                                              results.itertuples(index=False)):
+            previous.setdefault(key, (lat, lng, provider, display, int(score or 0)))
+    return previous
+
+
+def _geocode_row(geocoder, inputs):
+    addr, city, oblast, name, street_number, street_name, municipality = inputs
+    # Geocode - pass extracted metadata for better precision
+    result = geocoder.geocode(
+        addr, city, oblast, name, 
+        street_number_hint=street_number,
+        street_name_hint=street_name,
+        municipality=municipality
+    )
+    return result, geocoder.last_requests
+
+
+def _completed(row, future, duplicate):
+    result, requests_used = future.result()
+    return row, result, 0 if duplicate else requests_used
+
+
+def _geocode_chunk(geocoder, pool, chunk, rescore=False, window=16, carried=None):
+    """
+    Yield (row, result, requests_used) for a chunk of registry rows, in input order
+    Up to `window` rows are in flight at once; pacing is left to the
+    per-provider rate limiters. Rows in `carried` (chunk index -> result)
+    are passed through without geocoding
+    """
+    carried = carried or {}
+    rows = [(i, row, _row_inputs(row, geocoder)) for i, row in chunk.iterrows()]
+    
+    if rescore:
+        # Batch path: every cached response is scored in one vectorized pass
+        results = geocoder.rescore_rows([inputs for _, _, inputs in rows])
+        for (_, row, _), result in zip(rows, results):
+            yield row, result, 0
+        return
+    
+    # Identical normalized addresses share a single lookup
+    coalesced = {}
+    pending = deque()
+    for i, row, inputs in rows:
+        key = geocoder.cache_key(*inputs[:3])
+        if i in carried:
+            future, duplicate = Future(), False
+            future.set_result((carried[i], 0))
+        elif key in coalesced:
+            future, duplicate = coalesced[key], True
+        else:
+            future, duplicate = pool.submit(_geocode_row, geocoder, inputs), False
+            coalesced[key] = future
+        pending.append((row, future, duplicate))
+        while pending and (len(pending) >= window or pending[0][1].done()):
+            yield _completed(*pending.popleft())
+    while pending:
+        yield _completed(*pending.popleft())
+
+
+def _improve_row(geocoder, inputs, current, target, budget):
+    if not budget.allow():
+        return current, False
+    return geocoder.improve(*inputs, current, target, budget)
+
+
+def improve_results(geocoder, budget, target=80, path=OUTPUT_FILE, workers=4, tiers=TIER_FILES):
+    """
+    Spend `budget` on the weakest rows of an existing output, lowest quality_score first
+    Each row escalates until it reaches `target`; improved rows are written back
+    to `path` and the quality-tier files
+    Returns (rows tried, rows improved, rows that reached the target)
+    """
+    frame = pd.read_csv(path, encoding='utf-8', dtype=str, keep_default_na=False)
+    scores = pd.to_numeric(frame['quality_score'], errors='coerce').fillna(0).astype(int)
+    weakest = scores[scores < target].sort_values(kind='stable').index
+    
+    tried = improved = reached = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        for i in weakest:
+            row = frame.loc[i]
+            current = ((float(row['lat']), float(row['lng']), row['provider'] or None,
+                        row['display_name'] or None, int(scores[i]))
+                       if row['lat'] and row['lng'] else (None, None, None, None, 0))
+            # Queued in priority order, so the weakest rows run first
+            futures.append((i, current, pool.submit(_improve_row, geocoder, _row_inputs(row, geocoder),
+                                                    current, target, budget)))
+        for i, current, future in futures:
+            result, attempted = future.result()
+            if not attempted:
+                continue
+            tried += 1
+            lat, lng, provider, display, score = result
+            if score > current[4] or (lat, lng) != current[:2]:
+                improved += 1
+                frame.loc[i, RESULT_COLUMNS] = ['' if v is None else str(v) for v in result]
+                scores[i] = score
+            reached += score >= target
+    
+    if improved:
+        tmp = f"{path}.tmp"
+        frame.to_csv(tmp, index=False, encoding='utf-8', lineterminator='\n')
+        os.replace(tmp, path)
+        for tier_path, (_, keep) in tiers.items():
+            matching = scores.map(keep)
+            if matching.any() or os.path.exists(tier_path):
+                frame[matching].to_csv(tier_path, index=False, encoding='utf-8', lineterminator='\n')
+    return tried, improved, reached
+
+
+def _row_inputs(row, geocoder):
+    """Extract geocoding inputs from a registry row"""
+    addr = str(row.get('Адрес') or '').strip()
+    city = str(row.get('Населено място') or '').strip()
+    oblast = str(row.get('Област') or '').strip()
+    name = str(row.get('Наименование') or '').strip()
+    municipality = str(row.get('Община') or '').strip() or None
+    
+    # Use pre-extracted metadata if available
+    street_number = row.get('street_number') if 'street_number' in row and pd.notna(row.get('street_number')) else None
+    street_name = row.get('street_name_clean') if 'street_name_clean' in row and pd.notna(row.get('street_name_clean')) else None
+    
+    # Override extraction if we have better data
+    if not street_number:
+        street_number = geocoder._extract_street_number(clean_address(addr))
+    if not street_name:
+        street_name = geocoder._extract_street_name(clean_address(addr))
+    
+    return addr, city, oblast, name, street_number, street_name, municipality
+
+
+def _count_rows(path):
+    """Number of registry rows, reading a single column"""
+    return len(pd.read_csv(path, encoding='utf-8', usecols=[0]))
+
+
+def _quality_tier(score):
+    """Map a quality score to its statistics bucket"""
+    if score >= 80:
+        return 'excellent'
+    elif score >= 60:
+        return 'good'
+    elif score >= 40:
+        return 'fair'
+    return 'failed'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Ultimate hospital geocoder')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Rows geocoded concurrently (default: 4)')
+    parser.add_argument('--confidence', type=int, default=80,
+                        help='Stop trying strategies once a candidate reaches this score (default: 80)')
+    parser.add_argument('--rescore', action='store_true',
+                        help='Rebuild the output from cached raw responses only (no network calls)')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue an interrupted run from its checkpoint')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only geocode rows added or changed since the previous output; '
+                             'unchanged rows keep their coordinates')
+    parser.add_argument('--clean', action='store_true',
+                        help='Regenerate hospitals_official_cleaned.csv from hospitals_offical.csv and exit')
+    parser.add_argument('--check-clean', action='store_true',
+                        help='List the cells where cleaning hospitals_offical.csv differs from '
+                             'hospitals_official_cleaned.csv and exit')
+    parser.add_argument('--chunk-size', type=int, default=500,
+                        help='Registry rows read into memory at a time (default: 500)')
+    parser.add_argument('--max-age-days', type=float, default=POSITIVE_TTL_DAYS,
+                        help=f'Re-geocode stored winners older than this (default: {POSITIVE_TTL_DAYS})')
+    parser.add_argument('--negative-ttl-days', type=float, default=NEGATIVE_TTL_DAYS,
+                        help=f'Retry rows that failed more than this many days ago (default: {NEGATIVE_TTL_DAYS})')
+    parser.add_argument('--invalidate-provider', metavar='PROVIDER',
+                        help="Drop stored winners from this provider first (prefix match, e.g. 'overpass')")
+    parser.add_argument('--invalidate-below', type=int, metavar='SCORE',
+                        help='Drop stored winners scoring below SCORE first')
+    parser.add_argument('--invalidate-failed', action='store_true',
+                        help='Drop stored failures first, so every failed row is retried now')
+    parser.add_argument('--improve', action='store_true',
+                        help='Re-geocode the weakest rows of the existing output with escalating '
+                             'strategies, within --budget and --time-limit')
+    parser.add_argument('--budget', type=int, default=500,
+                        help='Network requests --improve may spend (default: 500)')
+    parser.add_argument('--time-limit', type=float, metavar='MINUTES',
+                        help='Wall-clock limit for --improve (default: none)')
+    parser.add_argument('--target-score', type=int, default=80,
+                        help='--improve stops on a row once it reaches this score (default: 80, Excellent)')
+    parser.add_argument('--parquet', metavar='PATH', nargs='?', const=PARQUET_FILE,
+                        help='Also write the output as Parquet with dictionary-encoded columns and a '
+                             f'quality_tier column; needs pyarrow (default path: {PARQUET_FILE})')
+    parser.add_argument('--no-map-export', action='store_true',
+                        help='Do not refresh map_data/ (the files index.html loads) at the end')
+    parser.add_argument('--gazetteer', metavar='INDEX',
+                        help='Local gazetteer index consulted before any network call '
+                             '(built with --build-gazetteer)')
+    parser.add_argument('--build-gazetteer', nargs='+', metavar='SOURCE',
+                        help='Build local_gazetteer.json from CSV/GeoJSON/OSM XML sources and exit')
+    parser.add_argument('--boundaries', metavar='INDEX',
+                        help='Settlement/municipality boundary index: candidates outside the expected '
+                             'Населено място are rejected (built with --build-boundaries)')
+    parser.add_argument('--build-boundaries', nargs='+', metavar='SOURCE',
+                        help='Build settlement_boundaries.json from GeoJSON administrative boundaries and exit')
+    parser.add_argument('--offline', action='store_true',
+                        help='Never touch the network: answer from the gazetteer and cached responses')
+    parser.add_argument('--trace', metavar='PATH', nargs='?', const='geocode_trace.jsonl',
+                        help='Append JSONL spans for every provider call, strategy and row '
+                             '(default path: geocode_trace.jsonl)')
+    parser.add_argument('--metrics', metavar='PATH', nargs='?', const='geocode_metrics.json',
+                        help='Write counters and latency histograms as JSON at the end of the run '
+                             '(default path: geocode_metrics.json)')
+    parser.add_argument('--metrics-port', type=int,
+                        help='Serve live metrics on http://127.0.0.1:PORT/metrics (Prometheus format)')
+    parser.add_argument('--nominatim-url', default=PROVIDER_URLS['nominatim'],
+                        help='Nominatim search endpoint (default: public OSM instance)')
+    parser.add_argument('--overpass-url', default=PROVIDER_URLS['overpass'],
+                        help='Overpass interpreter endpoint (default: overpass-api.de)')
+    parser.add_argument('--provider', action='append', type=parse_provider, metavar='NAME=KIND:URL[@RATE]',
+                        help='Search provider, repeatable, primary first; KIND is nominatim or photon, '
+                             'e.g. local=nominatim:http://localhost:8080/search@20 '
+                             '(default: public Nominatim at --nominatim-url)')
+    parser.add_argument('--hedge-after', type=float, default=HEDGE_AFTER,
+                        help=f'Seconds before the next provider is also asked (default: {HEDGE_AFTER})')
+    return parser.parse_args(argv)
+
+
+def build_geocoder(args):
+    """Geocoder, metrics registry and trace writer configured from the command line"""
+    gazetteer = None
+    if args.gazetteer:
+        from local_gazetteer import LocalGazetteer
+        gazetteer = LocalGazetteer.load(args.gazetteer)
+        print(f"Local gazetteer: {gazetteer.stats()}")
+    boundaries = None
+    if args.boundaries:
+        from settlement_boundaries import BoundaryIndex
+        boundaries = BoundaryIndex.load(args.boundaries)
+        print(f"Boundaries: {boundaries.stats()}")
+    geocoder = UltimateGeocoder(pool_size=args.workers, offline=args.rescore or args.offline,
+                                confidence_threshold=args.confidence, gazetteer=gazetteer,
+                                urls={'nominatim': args.nominatim_url, 'overpass': args.overpass_url},
+                                providers=args.provider, hedge_after=args.hedge_after,
+                                positive_ttl_days=args.max_age_days, negative_ttl_days=args.negative_ttl_days,
+                                boundaries=boundaries)
+    if args.invalidate_provider or args.invalidate_below is not None or args.invalidate_failed:
+        dropped = geocoder.cache.invalidate(provider=args.invalidate_provider,
+                                            below_score=args.invalidate_below, failed=args.invalidate_failed)
+        print(f"Invalidated {dropped} cached entries")
+    if args.provider:
+        print("Providers: " + " -> ".join(f"{p.name} ({p.url}, {p.rate:g}/s)" for p in geocoder.providers))
+    metrics = MetricsRegistry()
+    geocoder.observers.append(metrics)
+    trace = None
+    if args.trace:
+        trace = TraceWriter(args.trace)
+        geocoder.observers.append(trace)
+        print(f"Tracing spans to {args.trace}")
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+        print(f"Metrics: http://127.0.0.1:{args.metrics_port}/metrics")
+    return geocoder, metrics, trace
+
+
+def improve(args):
+    """--improve: spend a request budget on the weakest rows of the existing output"""
+    if not os.path.exists(OUTPUT_FILE):
+        print(f"{OUTPUT_FILE} not found - run a full geocoding pass first")
+        return
+    
+    print("="*70)
+    print(f"IMPROVING WEAK ROWS (target score {args.target_score})")
+    print("="*70)
+    geocoder, metrics, trace = build_geocoder(args)
+    if args.offline:
+        print("OFFLINE MODE: gazetteer and cached responses only, no network calls")
+    budget = RequestBudget(args.budget, args.time_limit * 60 if args.time_limit else None)
+    print(f"Budget: {args.budget} requests" +
+          (f", {args.time_limit:g} minutes" if args.time_limit else ""))
+    
+    start = time.time()
+    tried, improved, reached = improve_results(geocoder, budget, target=args.target_score,
+                                               workers=args.workers)
+    if trace is not None:
+        trace.close()
+    if args.metrics:
+        metrics.dump(args.metrics)
+    
+    print()
+    print(f"Rows tried: {tried} | Improved: {improved} | Reached target: {reached}")
+    print(f"Requests: {budget.spent} of {args.budget} | Time: {(time.time() - start)/60:.1f} minutes")
+    summary = metrics.strategy_summary()
+    if summary:
+        print("\nStrategies (runs / time / wins):")
+        for strategy, (runs, seconds, wins) in sorted(summary.items(), key=lambda s: -s[1][1]):
+            print(f"  {strategy:<30} {runs:>6} {seconds:>9.1f}s {wins:>6}")
+    if improved and args.parquet:
+        export_parquet(args.parquet)
+    if improved and not args.no_map_export:
+        export_map()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    
+    if args.clean:
+        df = clean_registry(pd.read_csv('hospitals_offical.csv', encoding='utf-8'))
+        df.to_csv('hospitals_official_cleaned.csv', index=False, encoding='utf-8')
+        print(f"Cleaned {len(df)} rows: hospitals_offical.csv -> hospitals_official_cleaned.csv")
+        return
+    
+    if args.check_clean:
+        raw, cleaned = (pd.read_csv(path, encoding='utf-8', dtype=str, keep_default_na=False)
+                        for path in ('hospitals_offical.csv', 'hospitals_official_cleaned.csv'))
+        differences = registry_differences(raw, cleaned)
+        for row, column, ours, theirs in differences.itertuples(index=False):
+            print(f"row {row} {column}:\n  clean_registry: {ours}\n  cleaned csv:    {theirs}")
+        print(f"{len(differences)} differing cells in {len(raw)} rows "
+              f"({differences['column'].value_counts().to_dict()})")
+        return
+    
+    if args.build_gazetteer:
+        from local_gazetteer import LocalGazetteer, GAZETTEER_FILE
+        gazetteer = LocalGazetteer.build(args.build_gazetteer)
+        gazetteer.save(GAZETTEER_FILE)
+        print(f"Gazetteer: {gazetteer.stats()} -> {GAZETTEER_FILE}")
+        return
+    
+    if args.build_boundaries:
+        from settlement_boundaries import BoundaryIndex, BOUNDARIES_FILE
+        boundaries = BoundaryIndex.build(args.build_boundaries)
+        boundaries.save(BOUNDARIES_FILE)
+        print(f"Boundaries: {boundaries.stats()} -> {BOUNDARIES_FILE}")
+        return
+    
+    if args.improve:
+        return improve(args)
+    
     print("="*70)
     print("ULTIMATE GEOCODING SOLUTION v2.0 - ENHANCED PRECISION")
     print("="*70)
@@ -452,118 +2470,179 @@ def main():
     
     # Load data - use improved version if available
     if os.path.exists('hospitals_official_improved.csv'):
-        df = pd.read_csv('hospitals_official_improved.csv', encoding='utf-8')
-        print(f"Loaded {len(df)} hospitals (IMPROVED DATA)")
+        source = 'hospitals_official_improved.csv'
+        total = _count_rows(source)
+        print(f"Loaded {total} hospitals (IMPROVED DATA)")
         print("Using extracted metadata: street_number, street_name_clean")
+    elif os.path.exists('hospitals_official_cleaned.csv'):
+        source = 'hospitals_official_cleaned.csv'
+        total = _count_rows(source)
+        print(f"Loaded {total} hospitals")
     else:
-        df = pd.read_csv('hospitals_official_cleaned.csv', encoding='utf-8')
-        print(f"Loaded {len(df)} hospitals")
+        # Raw registry - addresses are normalized on the fly by the geocoder
+        source = 'hospitals_offical.csv'
+        total = _count_rows(source)
+        print(f"Loaded {total} hospitals (RAW REGISTRY)")
     
-    print(f"Estimated time: ~{len(df) * 3 / 60:.1f} minutes (enhanced multi-strategy)")
+    print(f"Estimated time: ~{total * 3 / 60:.1f} minutes (enhanced multi-strategy)")
     print()
     
     # Initialize geocoder
-    geocoder = UltimateGeocoder()
-    
-    # Add result columns
-    for col in ['lat', 'lng', 'provider', 'display_name', 'quality_score']:
-        if col not in df.columns:
-            df[col] = None
-    
-    # Statistics
-    stats = {
-        'excellent': 0,  # score >= 80
-        'good': 0,       # score >= 60
-        'fair': 0,       # score >= 40
-        'failed': 0      # score < 40 or None
-    }
+    geocoder, metrics, trace = build_geocoder(args)
+    if args.rescore:
+        print("RESCORE MODE: scoring cached raw responses, no network calls")
+    elif args.offline:
+        print("OFFLINE MODE: gazetteer and cached responses only, no network calls")
+    
+    # Results are streamed to disk row by row with a checkpoint
+    writer = ResultWriter(source)
+    if args.resume and writer.resume():
+        print(f"Resuming after row {writer.next_row} (checkpoint: {writer.checkpoint})")
+    elif args.resume:
+        print("No checkpoint found, starting from the first row")
+    stats = writer.stats
+    
+    # Snapshot diff: keep the previous output aside, since it is about to be rewritten
+    previous = None
+    if args.incremental and not args.rescore:
+        if os.path.exists(writer.output) and not (args.resume and os.path.exists(PREVIOUS_FILE)):
+            shutil.copyfile(writer.output, PREVIOUS_FILE)
+        if os.path.exists(PREVIOUS_FILE):
+            previous = load_previous_results(PREVIOUS_FILE)
+            print(f"Incremental: {len(previous)} rows in the previous output; unchanged rows with "
+                  f"coordinates (or a fresh failure) are carried forward")
+        else:
+            print("Incremental: no previous output, geocoding everything")
+    carried_total = retried_total = 0
     
-    # Geocode all
     start = time.time()
+    resumed_at = writer.next_row
+    print(f"Workers: {args.workers}")
     
-    for i, row in df.iterrows():
-        addr = str(row.get('Адрес') or '').strip()
-        city = str(row.get('Населено място') or '').strip()
-        oblast = str(row.get('Област') or '').strip()
-        name = str(row.get('Наименование') or '').strip()
-        
-        # Use pre-extracted metadata if available
-        street_number = row.get('street_number') if 'street_number' in row and pd.notna(row.get('street_number')) else None
-        street_name = row.get('street_name_clean') if 'street_name_clean' in row and pd.notna(row.get('street_name_clean')) else None
-        
-        # Override extraction if we have better data
-        if not street_number:
-            street_number = geocoder._extract_street_number(addr)
-        if not street_name:
-            street_name = geocoder._extract_street_name(addr)
-        
-        # Progress
-        if (i + 1) % 20 == 0 or i == 0:
-            elapsed = time.time() - start
-            rate = (i + 1) / elapsed if elapsed > 0 else 0
-            remaining = (len(df) - i - 1) / rate if rate > 0 else 0
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        chunks = pd.read_csv(source, encoding='utf-8', chunksize=args.chunk_size,
+                             skiprows=range(1, writer.next_row + 1))
+        for chunk in chunks:
+            # Add result columns
+            for col in RESULT_COLUMNS:
+                if col not in chunk.columns:
+                    chunk[col] = None
             
-            print(f"[{i+1}/{len(df)}] {(i+1)/len(df)*100:.1f}% | "
-                  f"Elapsed: {elapsed/60:.1f}m | Remaining: ~{remaining/60:.1f}m")
-            print(f"  Quality: Excellent={stats['excellent']} Good={stats['good']} "
-                  f"Fair={stats['fair']} Failed={stats['failed']}")
-        
-        # Geocode - pass extracted metadata for better precision
-        lat, lng, provider, display, score = geocoder.geocode(
-            addr, city, oblast, name, 
-            street_number_hint=street_number,
-            street_name_hint=street_name
-        )
-        
-        df.at[i, 'lat'] = lat
-        df.at[i, 'lng'] = lng
-        df.at[i, 'provider'] = provider
-        df.at[i, 'display_name'] = display
-        df.at[i, 'quality_score'] = score
-        
-        # Update stats
-        if score >= 80:
-            stats['excellent'] += 1
-        elif score >= 60:
-            stats['good'] += 1
-        elif score >= 40:
-            stats['fair'] += 1
-        else:
-            stats['failed'] += 1
+            keys = list(zip(chunk.index,
+                            chunk['Адрес'].fillna('').astype(str).str.strip(),
+                            chunk['Населено място'].fillna('').astype(str).str.strip(),
+                            chunk['Област'].fillna('').astype(str).str.strip()))
+            
+            # Rows whose content hash matches the previous run are not geocoded again;
+            # a row without coordinates only while its negative cache entry is fresh
+            carried = {}
+            if previous:
+                for (i, addr, city, oblast), key in zip(keys, row_hashes(chunk)):
+                    result = previous.get(key)
+                    if result is None:
+                        continue
+                    if result[0] is not None or geocoder.is_fresh(geocoder.cached_result(addr, city, oblast)):
+                        carried[i] = result
+                    else:
+                        retried_total += 1
+                carried_total += len(carried)
+            
+            # Prefetch Overpass POIs once per settlement that still needs geocoding
+            pending_cities = [
+                settlement for i, addr, city, oblast in keys
+                if i not in carried
+                and (args.rescore or not geocoder.is_fresh(geocoder.cached_result(addr, city, oblast)))
+                for settlement in row_settlements(addr, city)
+            ]
+            if pending_cities:
+                settlements, pois = geocoder.prefetch_settlements(pending_cities, workers=args.workers)
+                print(f"Overpass prefetch: {settlements} settlements, {pois} POIs")
+            
+            for row, result, requests_used in _geocode_chunk(
+                    geocoder, pool, chunk, rescore=args.rescore, window=args.workers * 4,
+                    carried=carried):
+                writer.write(row, result, requests_used)
+                
+                # Progress
+                done = writer.next_row
+                if done % 20 == 0 or done == resumed_at + 1:
+                    elapsed = time.time() - start
+                    rate = (done - resumed_at) / elapsed if elapsed > 0 else 0
+                    remaining = (total - done) / rate if rate > 0 else 0
+                    
+                    print(f"[{done}/{total}] {done/total*100:.1f}% | "
+                          f"Elapsed: {elapsed/60:.1f}m | Remaining: ~{remaining/60:.1f}m")
+                    print(f"  Quality: Excellent={stats['excellent']} Good={stats['good']} "
+                          f"Fair={stats['fair']} Failed={stats['failed']} | Requests: {writer.requests}")
     
-    # Save results
-    output = 'hospitals_ultimate_coords.csv'
-    df.to_csv(output, index=False, encoding='utf-8')
+    writer.close()
+    if trace is not None:
+        trace.close()
+    if args.metrics:
+        metrics.dump(args.metrics)
+    if previous is not None and os.path.exists(PREVIOUS_FILE):
+        os.remove(PREVIOUS_FILE)
     
     # Final report
     total_time = time.time() - start
-    success_rate = (stats['excellent'] + stats['good'] + stats['fair']) / len(df) * 100
+    processed = max(sum(stats.values()), 1)
+    success_rate = (stats['excellent'] + stats['good'] + stats['fair']) / processed * 100
     
     print()
     print("="*70)
     print("GEOCODING COMPLETE")
     print("="*70)
-    print(f"Total hospitals: {len(df)}")
-    print(f"  *** Excellent (80-100): {stats['excellent']} ({stats['excellent']/len(df)*100:.1f}%)")
-    print(f"  **  Good (60-79): {stats['good']} ({stats['good']/len(df)*100:.1f}%)")
-    print(f"  *   Fair (40-59): {stats['fair']} ({stats['fair']/len(df)*100:.1f}%)")
-    print(f"  X   Failed (<40): {stats['failed']} ({stats['failed']/len(df)*100:.1f}%)")
+    print(f"Total hospitals: {processed}")
+    print(f"  *** Excellent (80-100): {stats['excellent']} ({stats['excellent']/processed*100:.1f}%)")
+    print(f"  **  Good (60-79): {stats['good']} ({stats['good']/processed*100:.1f}%)")
+    print(f"  *   Fair (40-59): {stats['fair']} ({stats['fair']/processed*100:.1f}%)")
+    print(f"  X   Failed (<40): {stats['failed']} ({stats['failed']/processed*100:.1f}%)")
     print(f"\nOverall success rate: {success_rate:.1f}%")
     print(f"Total time: {total_time/60:.1f} minutes")
-    print(f"Average: {total_time/len(df):.2f} seconds per hospital")
-    print(f"\nOutput: {output}")
+    print(f"Average: {total_time/max(processed - resumed_at, 1):.2f} seconds per hospital")
+    print(f"Requests: {writer.requests} ({writer.requests/processed:.2f} per hospital)")
+    provider_errors = metrics.value('geocode_rows_total', outcome='provider_error')
+    if provider_errors:
+        print(f"Failed on provider errors (retries exhausted / circuit open): {provider_errors} "
+              f"- rerun after the outage; cached rows cost no requests")
+    if previous is not None:
+        print(f"Carried forward unchanged: {carried_total} | "
+              f"Retried (unchanged, failure expired): {retried_total} | "
+              f"Geocoded (added/modified): {processed - resumed_at - carried_total - retried_total}")
+    summary = metrics.strategy_summary()
+    if summary:
+        print("\nStrategies (runs / time / wins):")
+        for strategy, (runs, seconds, wins) in sorted(summary.items(), key=lambda s: -s[1][1]):
+            print(f"  {strategy:<30} {runs:>6} {seconds:>9.1f}s {wins:>6}")
+    print(f"\nOutput: {writer.output}")
+    if args.metrics:
+        print(f"Metrics: {args.metrics}")
     print("="*70)
     
-    # Export by quality
-    excellent = df[df['quality_score'] >= 80]
-    if len(excellent) > 0:
-        excellent.to_csv('hospitals_excellent.csv', index=False, encoding='utf-8')
-        print(f"Excellent quality: hospitals_excellent.csv ({len(excellent)} rows)")
-    
-    failed = df[df['quality_score'] < 40]
-    if len(failed) > 0:
-        failed.to_csv('hospitals_needs_manual.csv', index=False, encoding='utf-8')
-        print(f"Needs manual review: hospitals_needs_manual.csv ({len(failed)} rows)")
+    # Quality exports were written in the same pass
+    for path, (label, _) in writer.tiers.items():
+        if writer.counts.get(path):
+            print(f"{label}: {path} ({writer.counts[path]} rows)")
+    if args.parquet:
+        export_parquet(args.parquet)
+    if not args.no_map_export:
+        export_map()
+
+
+def export_parquet(path):
+    try:
+        rows = write_parquet(OUTPUT_FILE, path)
+    except RuntimeError as e:
+        print(f"Parquet output skipped: {e}")
+        return
+    print(f"Parquet: {path} ({rows} rows)")
+
+
+def export_map():
+    """Refresh the precomputed map data behind index.html"""
+    from export_map_data import export, MAP_DATA_DIR
+    index = export(OUTPUT_FILE, MAP_DATA_DIR)
+    print(f"Map data: {index['with_coords']} points in {len(index['oblasts'])} oblasts -> {MAP_DATA_DIR}/")
 
 if __name__ == '__main__':
     main()